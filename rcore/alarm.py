@@ -25,13 +25,11 @@
 
 from __future__ import absolute_import
 
-from twisted.web.xmlrpc import Proxy
-
 from rcore.config import config
-from rcore.xmlrpc import Service
+from rcore.xmlrpc import Service, getProxy
 
 class Alarm(Service):
     restoreContext = False
     
     def _getProxy(self):
-        return Proxy(config()['hermes']['url'].encode("utf-8"))
+        return getProxy(config()['hermes']['url'])
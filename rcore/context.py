@@ -40,6 +40,7 @@ from twisted.python import log as twistedLog
 from twisted.internet import defer
 
 #from rcore.queue import DQueue
+from rcore.debug import debug
 from rcore.error import InternalError
 
 _contextData = {
@@ -164,9 +165,8 @@ def executeInExactContext(func, constructor, *args, **kw):
     @param kw:
     @return:
     """
-    from rcore.core import Core
-    if Core.instance().debugEnabled():
-        print ("Context: execute in context: " + str(func))
+    if debug.enabled:
+        debug.trace("Context: execute in context: " + str(func))
     
     def deleteTempContext(result):
         deleteContext(contextId)
@@ -35,6 +35,7 @@ from twisted.python.logfile import DailyLogFile
 from twisted.internet import reactor, defer
 
 from rcore.context import Context, makeContext, setCurrentContext
+from rcore.debug import debug
 from rcore.rpctools import RPCService
 from rcore.error import InternalError
 from rcore.observer import Observable
@@ -95,6 +96,8 @@ class Core(Observable):
 
         from rcore.config import config
         config.reload(configFile)
+        debug.update(config())
+        config.connect("changed", debug.configChanged)
         try:
             logDest = config()['log']['destination']
             if logDest == 'syslog':
@@ -171,13 +174,7 @@ class Core(Observable):
         return self._users[login]
     
     def debugEnabled(self, opt=""):
-        from rcore.config import config
-        try:
-            if config()['debug']['enable']:
-                return bool(int(config()['debug'].get(opt, True))) if opt else True
-        except:
-            pass
-        return False
+        return debug(opt)
     
     def hostIp(self):
         import socket
@@ -0,0 +1,213 @@
+# Copyright (c) 2013, Il'inykh Sergey
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL IL'INYKH SERGEY BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Cron expressions for scheduler
+#
+# usage:
+# from rcore.cron import CronExpression
+# cron = CronExpression("15 2 * * mon-fri") # every weekday at 02:15
+# cron.next(datetime.now())                 # next fire time strictly after given one
+#
+# Standard 5 fields are supported: minute hour day-of-month month day-of-week
+# with lists, ranges, steps, month/day names and @hourly-like aliases.
+# As in vixie cron when both day fields are restricted, day matching either of them fires.
+# Field starting with * (like */2) is not restricted, so both fields have to match then.
+#
+# Time zones are tzinfo instances or names (names require pytz).
+# Local times skipped by DST transition never fire, ambiguous ones fire once (first occurrence).
+
+from __future__ import absolute_import
+
+import bisect
+from datetime import datetime, timedelta, tzinfo
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+from rcore.error import SchedulerError
+
+ALIASES = {
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+    "@monthly": "0 0 1 * *",
+    "@weekly": "0 0 * * 0",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@hourly": "0 * * * *",
+}
+
+MONTHS = ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"]
+DAYS = ["sun", "mon", "tue", "wed", "thu", "fri", "sat"]
+
+MAX_YEARS = 10 # how far we look for fire time before giving up (e.g. "0 0 30 2 *")
+
+
+def getTimezone(tz):
+    """
+    @param tz: None, tzinfo instance or time zone name
+    @return: tzinfo or None
+    """
+    if tz is None or isinstance(tz, tzinfo):
+        return tz
+    if pytz is None:
+        raise SchedulerError("pytz is required for named time zones")
+    try:
+        return pytz.timezone(tz)
+    except pytz.UnknownTimeZoneError:
+        raise SchedulerError("Unknown time zone: %s" % tz)
+
+
+def localize(tz, naive):
+    """
+    Attaches time zone to naive local time.
+
+    @return: aware datetime or None if such local time does not exist
+    """
+    if not hasattr(tz, "localize"): # not pytz, trust tzinfo
+        return naive.replace(tzinfo=tz)
+    try:
+        return tz.localize(naive, is_dst=None)
+    except pytz.NonExistentTimeError:
+        return None
+    except pytz.AmbiguousTimeError:
+        return tz.localize(naive, is_dst=True)
+
+
+class CronExpression(object):
+    """
+    Compiled cron expression. Every field is kept as sorted list of allowed values,
+    so next fire time is found with a few bisects and carries instead of minute by minute scan.
+    """
+
+    def __init__(self, expr):
+        self.expr = expr
+        fields = ALIASES.get(expr.strip().lower(), expr).split()
+        if len(fields) != 5:
+            raise SchedulerError("Cron expression must have 5 fields: %s" % expr)
+        self.minutes = self._parseField(fields[0], 0, 59)
+        self.hours = self._parseField(fields[1], 0, 23)
+        self.days = self._parseField(fields[2], 1, 31)
+        self.months = self._parseField(fields[3], 1, 12, MONTHS, 1)
+        self.weekdays = sorted(set(d % 7 for d in self._parseField(fields[4], 0, 7, DAYS, 0)))
+        self.anyDay = fields[2].startswith(("*", "?"))
+        self.anyWeekday = fields[4].startswith(("*", "?"))
+
+    def __repr__(self):
+        return "CronExpression(%r)" % self.expr
+
+    def _parseField(self, field, low, high, names=None, namesBase=0):
+        def value(v):
+            v = v.lower()
+            if names and v in names:
+                return names.index(v) + namesBase
+            try:
+                v = int(v)
+            except ValueError:
+                raise SchedulerError("Invalid value %s in cron field %s" % (v, field))
+            if v < low or v > high:
+                raise SchedulerError("Value %d out of range in cron field %s" % (v, field))
+            return v
+
+        ret = set()
+        for part in field.split(","):
+            rng, _, step = part.partition("/")
+            try:
+                step = int(step) if step else 1
+            except ValueError:
+                raise SchedulerError("Invalid step in cron field %s" % field)
+            if step < 1:
+                raise SchedulerError("Invalid step in cron field %s" % field)
+            if rng in ("*", "?"):
+                start, end = low, high
+            elif "-" in rng:
+                start, end = [value(v) for v in rng.split("-", 1)]
+            else:
+                start = value(rng)
+                end = high if step > 1 else start
+            if start > end:
+                raise SchedulerError("Invalid range in cron field %s" % field)
+            ret.update(range(start, end + 1, step))
+        return sorted(ret)
+
+    def _dayMatches(self, d):
+        inDays = d.day in self.days
+        inWeekdays = (d.weekday() + 1) % 7 in self.weekdays
+        if self.anyDay or self.anyWeekday:
+            return inDays and inWeekdays
+        return inDays or inWeekdays
+
+    def _nextLocal(self, after):
+        """Next matching naive time strictly after given naive one"""
+        t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = after.year + MAX_YEARS
+        while t.year <= limit:
+            if t.month not in self.months:
+                i = bisect.bisect_left(self.months, t.month)
+                if i == len(self.months):
+                    t = datetime(t.year + 1, self.months[0], 1)
+                else:
+                    t = datetime(t.year, self.months[i], 1)
+                continue
+            if not self._dayMatches(t):
+                t = datetime(t.year, t.month, t.day) + timedelta(days=1) # month carry is checked above
+                continue
+            if t.hour not in self.hours:
+                i = bisect.bisect_left(self.hours, t.hour)
+                if i == len(self.hours):
+                    t = datetime(t.year, t.month, t.day) + timedelta(days=1)
+                else:
+                    t = datetime(t.year, t.month, t.day, self.hours[i])
+                continue
+            if t.minute not in self.minutes:
+                i = bisect.bisect_left(self.minutes, t.minute)
+                if i == len(self.minutes):
+                    t = datetime(t.year, t.month, t.day, t.hour) + timedelta(hours=1)
+                else:
+                    t = t.replace(minute=self.minutes[i])
+                continue
+            return t
+        raise SchedulerError("Cron expression %s never fires" % self.expr)
+
+    def next(self, after, tz=None):
+        """
+        Computes next fire time strictly after given time.
+
+        @param after: naive local time or aware datetime if tz is set
+        @param tz: time zone fire times are computed in
+        @return: naive datetime or aware one if tz is set
+        """
+        tz = getTimezone(tz)
+        if tz is None:
+            return self._nextLocal(after)
+        if after.tzinfo is None:
+            after = localize(tz, after) or localize(tz, after + timedelta(hours=1))
+        local = after.astimezone(tz).replace(tzinfo=None)
+        while True:
+            local = self._nextLocal(local)
+            ret = localize(tz, local)
+            if ret is not None and ret > after: # skipped or second occurrence of ambiguous time
+                return ret
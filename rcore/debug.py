@@ -0,0 +1,76 @@
+# Copyright (c) 2013, Il'inykh Sergey
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL IL'INYKH SERGEY BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Debug flags snapshot and tracing
+#
+# "debug" section of config is parsed once and then again only when config emits "changed",
+# so hot paths check plain attribute instead of walking config:
+#
+# from rcore.debug import debug
+# if debug.enabled:
+#     debug.trace("ActionQueue: something happened")
+#
+# debug("option") returns value of debug.option flag (True if not set) when debug is enabled
+
+from __future__ import absolute_import
+
+
+class DebugFlags(object):
+    def __init__(self):
+        self.enabled = False
+        self._options = {}
+
+    def update(self, conf):
+        """
+        Rebuilds flags from config data (result of config())
+        """
+        try:
+            section = conf['debug']
+            enabled = bool(section['enable'])
+        except Exception:
+            section = {}
+            enabled = False
+        options = {}
+        for name, value in section.items():
+            try:
+                options[name] = bool(int(value))
+            except (TypeError, ValueError):
+                options[name] = False
+        self._options = options
+        self.enabled = enabled
+
+    def configChanged(self, config):
+        self.update(config())
+
+    def __call__(self, opt=""):
+        if not self.enabled:
+            return False
+        return self._options.get(opt, True) if opt else True
+
+    def trace(self, msg):
+        print(msg)
+
+
+debug = DebugFlags()
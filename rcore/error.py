@@ -61,6 +61,9 @@ class InternalError(RegularError):
 class SchedulerError(RegularError):
     code = "SCHEDULER_ERROR"
 
+class QueueOverflowError(RegularError):
+    code = "QUEUE_OVERFLOW"
+
 class InvalidParametersError(RegularError):
     code = "INVALID_PARAMETERS"
 
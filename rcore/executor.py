@@ -0,0 +1,219 @@
+# Copyright (c) 2013, Il'inykh Sergey
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL IL'INYKH SERGEY BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Executors run blocking or cpu heavy callables out of reactor thread
+#
+# usage:
+# from rcore.executor import getExecutor
+# d = getExecutor("thread", 4).run(func, arg1, arg2)  # Deferred fired in reactor thread
+#
+# Current context is restored before result is passed to callbacks.
+# Keep in mind contexts are not thread safe, so executed func must not rely on getContext().
+# Process executor requires func, args and result to be picklable, otherwise Deferred fails with InternalError.
+# Cancelling returned Deferred doesn't stop func, its result is just dropped.
+
+from __future__ import absolute_import
+
+import pickle
+import traceback
+
+from twisted.internet import reactor, defer
+from twisted.python import log
+from twisted.python.threadpool import ThreadPool
+
+from rcore.context import getCurrentContextId, setCurrentContext
+from rcore.error import ContextError, InternalError, InvalidParametersError, RegularError
+
+THREAD = "thread"
+PROCESS = "process"
+
+_executors = {}
+
+
+def _callInProcess(payload):
+    """
+    Executed in worker process. Gets pickled (func, args, kw) and returns pickled (success, result),
+    so pool itself never fails to pass call or its result and the caller is always answered.
+    """
+    try:
+        func, args, kw = pickle.loads(payload)
+        result = True, func(*args, **kw)
+    except Exception as e:
+        result = False, (e, traceback.format_exc())
+    try:
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        if result[0]:
+            result = False, (InternalError("Unable to pickle result: %s" % e), traceback.format_exc())
+        else:
+            result = False, (InternalError(repr(result[1][0])), result[1][1])
+        return pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+
+class Executor(object):
+    def __init__(self, size):
+        self.size = size
+
+    def run(self, func, *args, **kw):
+        """
+        Executes func out of reactor thread.
+
+        @return: Deferred fired with func's result in reactor thread
+        """
+        contextId = getCurrentContextId()
+
+        def restoreContext(result):
+            try:
+                setCurrentContext(contextId)
+            except Exception as e:
+                log.msg("Executor: Unable to restore context. Actual result was: " + str(result))
+                return ContextError(str(e)).toFailure()
+            return result
+
+        d = self._run(func, args, kw)
+        d.addBoth(restoreContext)
+        return d
+
+    def _run(self, func, args, kw):
+        raise NotImplementedError("_run must be implemented in an inherited class")
+
+    def _deliver(self, d, success, result):
+        """Passes result to Deferred in reactor thread unless it was cancelled"""
+        if d.called:
+            return
+        if success:
+            d.callback(result)
+        else:
+            d.errback(result)
+
+    def resize(self, size):
+        """Changes pool size. Already started calls are finished by old workers"""
+        self.size = size
+
+    def stop(self):
+        pass
+
+
+class ThreadExecutor(Executor):
+    def __init__(self, size):
+        super(ThreadExecutor, self).__init__(size)
+        self._pool = ThreadPool(0, size, "rcore-executor")
+        self._pool.start()
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def _run(self, func, args, kw):
+        d = defer.Deferred()
+
+        def finished(success, result): # called in pool's thread
+            reactor.callFromThread(self._deliver, d, success, result)
+
+        self._pool.callInThreadWithCallback(finished, func, *args, **kw)
+        return d
+
+    def resize(self, size):
+        if size != self.size:
+            super(ThreadExecutor, self).resize(size)
+            self._pool.adjustPoolsize(0, size)
+
+    def stop(self):
+        if self._pool.started:
+            self._pool.stop()
+
+
+class ProcessExecutor(Executor):
+    def __init__(self, size):
+        super(ProcessExecutor, self).__init__(size)
+        import multiprocessing
+        self._multiprocessing = multiprocessing
+        self._pool = multiprocessing.Pool(size)
+        reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+
+    def _run(self, func, args, kw):
+        try:
+            payload = pickle.dumps((func, args, kw), pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            return defer.fail(InternalError("Unable to pickle call of %r: %s" % (func, e)))
+        d = defer.Deferred()
+
+        def finished(result): # called in pool's result handler thread
+            reactor.callFromThread(self._finished, d, result)
+
+        self._pool.apply_async(_callInProcess, (payload,), callback=finished)
+        return d
+
+    def _finished(self, d, result):
+        try:
+            success, value = pickle.loads(result)
+        except Exception as e:
+            success, value = False, (InternalError("Unable to unpickle result: %s" % e), traceback.format_exc())
+        if not success:
+            value, tb = value
+            if not isinstance(value, RegularError):
+                log.msg("Executor: process job failed:\n" + tb)
+        self._deliver(d, success, value)
+
+    def resize(self, size):
+        if size != self.size and self._pool:
+            super(ProcessExecutor, self).resize(size)
+            # multiprocessing pool can't be resized. old one finishes queued calls and its workers exit
+            self._pool.close()
+            self._pool = self._multiprocessing.Pool(size)
+
+    def stop(self):
+        if self._pool:
+            self._pool.terminate()
+            self._pool = None
+
+
+_kinds = {THREAD: ThreadExecutor, PROCESS: ProcessExecutor}
+
+
+def createExecutor(kind, size=4):
+    """
+    Returns new executor owned by caller. Use getExecutor to share pools.
+
+    @param kind: "thread" or "process"
+    @param size: int number of threads or processes in the pool
+    @rtype: Executor
+    """
+    if kind not in _kinds:
+        raise InvalidParametersError("Unknown executor kind: " + str(kind))
+    if int(size) < 1:
+        raise InvalidParametersError("Executor size must be positive")
+    return _kinds[kind](int(size))
+
+
+def getExecutor(kind, size=4):
+    """
+    Returns shared executor of passed kind and size. it's created on first request.
+
+    @param kind: "thread" or "process"
+    @param size: int number of threads or processes in the pool
+    @rtype: Executor
+    """
+    key = (kind, int(size))
+    if key not in _executors:
+        _executors[key] = createExecutor(kind, size)
+    return _executors[key]
@@ -0,0 +1,180 @@
+# Copyright (c) 2013, Il'inykh Sergey
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL IL'INYKH SERGEY BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Lease stores for cluster-wide singleton scheduler jobs
+#
+# Lease is a named lock owned by one node until it expires.
+# Scheduler acquires a lease for every occurrence of singleton job, so only one node runs it
+# (see SchedulerJob.setSingleton and Scheduler.setLeaseStore).
+#
+# usage:
+# from rcore.lease import SQLiteLeaseStore
+# scheduler.setLeaseStore(SQLiteLeaseStore("/var/lib/mydaemon/leases.db"))
+# scheduler.job(aggregate).setName("aggregate").setSingleton().repeated(60).start("00:00:00")
+#
+# Bundled stores are local (nodes have to share the file) and block reactor for a moment,
+# so they are mostly for testing and single host setups. Other stores should implement
+# LeaseStore interface and may return not fired Deferreds.
+
+from __future__ import absolute_import
+
+import os
+import socket
+import time
+
+from twisted.internet import defer
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+PURGE_GRACE = 3600 # seconds expired lease is kept before removal by file store
+
+
+def defaultOwner():
+    """Name of this node"""
+    return "%s:%d" % (socket.gethostname(), os.getpid())
+
+
+class LeaseStore(object):
+    def acquire(self, key, owner, ttl):
+        """
+        Acquires lease if it's free, expired or already owned by the owner
+
+        @param key: string lease name
+        @param owner: string node name
+        @param ttl: seconds lease is valid
+        @return: Deferred fired with True if lease is acquired
+        """
+        raise NotImplementedError("acquire must be implemented in an inherited class")
+
+    def release(self, key, owner):
+        """
+        Releases lease if it's owned by the owner
+
+        @return: Deferred
+        """
+        raise NotImplementedError("release must be implemented in an inherited class")
+
+
+class SQLiteLeaseStore(LeaseStore):
+    def __init__(self, path, timeout=5):
+        import sqlite3
+
+        self._db = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self._db.execute("CREATE TABLE IF NOT EXISTS leases "
+                         "(key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS leases_expires ON leases (expires)")
+
+    def acquire(self, key, owner, ttl):
+        return defer.maybeDeferred(self._acquire, key, owner, ttl)
+
+    def _acquire(self, key, owner, ttl):
+        now = time.time()
+        db = self._db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute("DELETE FROM leases WHERE expires < ?", (now,))
+            cur = db.execute("INSERT OR IGNORE INTO leases (key, owner, expires) VALUES (?, ?, ?)",
+                             (key, owner, now + ttl))
+            if cur.rowcount == 0:
+                cur = db.execute("UPDATE leases SET expires = ? WHERE key = ? AND owner = ?", (now + ttl, key, owner))
+            acquired = cur.rowcount == 1
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        return acquired
+
+    def release(self, key, owner):
+        return defer.maybeDeferred(self._db.execute, "DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+
+class FileLeaseStore(LeaseStore):
+    """
+    Keeps each lease in its own file of the directory. Files are locked with flock while lease is checked.
+    """
+    def __init__(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self._purgedAt = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, quote(key, safe="") + ".lease")
+
+    def _update(self, key, check):
+        """
+        Reads lease under lock and writes (owner, expires) returned by check unless it's None
+
+        @return: True if lease was written
+        """
+        import fcntl
+
+        fd = os.open(self._path(key), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.read(fd, 1024).decode("utf-8").split("\n")
+            current = (data[0], float(data[1])) if len(data) > 1 and data[1] else (None, 0)
+            lease = check(*current)
+            if lease is None:
+                return False
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, ("%s\n%f" % lease).encode("utf-8"))
+            return True
+        finally:
+            os.close(fd) # releases lock
+
+    def acquire(self, key, owner, ttl):
+        now = time.time()
+
+        def check(currentOwner, expires):
+            if currentOwner in (None, owner) or expires < now:
+                return owner, now + ttl
+
+        d = defer.maybeDeferred(self._update, key, check)
+        if now - self._purgedAt > PURGE_GRACE:
+            self._purgedAt = now
+            self._purge(now)
+        return d
+
+    def release(self, key, owner):
+        return defer.maybeDeferred(self._update, key, lambda o, e: ("", 0) if o == owner else None)
+
+    def _purge(self, now):
+        """Removes files of leases expired long ago, so nobody is going to acquire them"""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(".lease"):
+                continue
+            try:
+                with open(path) as f:
+                    expires = float(f.read().split("\n")[1] or 0)
+                if expires < now - PURGE_GRACE:
+                    os.unlink(path)
+            except (OSError, IOError, IndexError, ValueError):
+                pass
@@ -25,12 +25,19 @@
 
 from __future__ import absolute_import
 
+import bisect
+import collections
+import time
+
 from twisted.internet import reactor, defer
-from twisted.python import log
+from twisted.python import log, failure
 
+from rcore import stats
+from rcore.debug import debug
 from rcore.context import waitForDeferred, getCurrentContextId,\
     setCurrentContext
-from rcore.error import getFailureFor, ContextError, RegularError, InternalError
+from rcore.error import getFailureFor, ContextError, RegularError, InternalError,\
+    InvalidParametersError, QueueOverflowError
 
 # in order to use this class in some context-free place like Core
 # you have to create context and set it as current
@@ -61,25 +68,47 @@ class DQueue(object):
     d = q.run()
     d.addCallback(handle_results)
 
+    By default items are handled one by one. Call setConcurrency(n) before run()
+    to keep up to n works running at the same time (results are still in items order).
+    Blocking or cpu heavy work may be moved out of reactor thread with setExecutor.
+    Execution statistics are available with stats().
+
     """
     def __init__(self, items, work, *args, **kw):
         """
-        @param items: list of items
+        @param items: list of items or any other iterable (generators are consumed lazily)
         @param work: Callable wor
         @param args: list of args passed to work
         @param kw: dict of kwargs passed to work
         @return:
         """
-        self._items = items[:]
+        # lists are copied since callers may modify them while queue works (see Observable.emit)
+        self._items = iter(items[:] if isinstance(items, list) else items)
         self._work = work
         self._args = args
         self._kw = kw
         self._results = []
+        self._resultHandler = None
         self._stopOnFailure = False
         self._success = True
         self._successCount = 0
         self._lastResult = None
         self._firstError = None
+        self._concurrency = 1
+        self._executor = None
+        self._stats = stats.QueueStats()
+
+    def setName(self, name):
+        """
+        Registers queue statistics under passed name (see rcore.stats.collect("queue"))
+        """
+        stats.register("queue", name, self)
+
+    def stats(self):
+        """
+        @return: dict with execution time histogram, throughput and failures
+        """
+        return self._stats.toDict()
 
     def setStopOnFailure(self, status=True):
         """
@@ -88,36 +117,177 @@ class DQueue(object):
         """
         self._stopOnFailure = status
 
-    @defer.deferredGenerator
+    def setConcurrency(self, limit):
+        """
+        Sets max number of works running at the same time.
+
+        constructor kwargs are passed to work, so the limit is set with this method.
+        @param limit: int max number of not finished works. 1 means one by one (default)
+        """
+        if int(limit) < 1:
+            raise InvalidParametersError("DQueue concurrency must be positive")
+        self._concurrency = int(limit)
+
+    def setExecutor(self, kind=None, size=4):
+        """
+        Makes work executed in thread or process pool instead of reactor thread.
+
+        Don't forget to set concurrency to use more than one worker of the pool.
+        @param kind: "thread", "process" or None to execute in reactor thread (default)
+        @param size: int pool size
+        """
+        from rcore.executor import getExecutor
+        self._executor = getExecutor(kind, size) if kind else None
+
+    def _call(self, item):
+        self._stats.enqueued += 1
+        self._stats.started()
+        startedAt = time.time()
+        if self._executor:
+            d = self._executor.run(self._work, item, *self._args, **self._kw)
+        else:
+            d = defer.maybeDeferred(self._work, item, *self._args, **self._kw)
+        d.addBoth(self._measure, startedAt)
+        return d
+
+    def _measure(self, result, startedAt):
+        self._stats.finished(time.time() - startedAt, isinstance(result, failure.Failure))
+        return result
+
+    def setResultHandler(self, handler=None):
+        """
+        Sets callable which receives each result as soon as it's ready instead of storing it.
+
+        handler is called like handler(success, result, item) in order of works completion.
+        if it returns Deferred next item waits for it, so slow handler slows down the queue.
+        with handler set results list passed to run's callback is empty.
+        @param handler: Callable or None to store results again
+        """
+        self._resultHandler = handler if hasattr(handler, "__call__") else None
+
     def run(self):
-        while len(self._items):
-            item = self._items.pop(0)
-            wfd = waitForDeferred(defer.maybeDeferred(self._work, item, *self._args, **self._kw))
+        """
+        Starts handling of items.
+
+        @return: Deferred fired with results list
+        """
+        if self._concurrency > 1:
+            return self._runConcurrent()
+        return self._runSequential()
+
+    @defer.deferredGenerator
+    def _runSequential(self):
+        for item in self:
+            wfd = waitForDeferred(self._call(item))
             yield wfd
+            stopFailure = None
             try:
                 result = wfd.getResult()
                 self._successCount += 1
                 self._lastResult = [True, result, item]
-                self._results.append(self._lastResult)
             except Exception as e:
                 self._success = False
-                failure = getFailureFor(e)
-                if not failure.check(RegularError):
-                    failure.printTraceback()
+                fail = getFailureFor(e)
+                if not fail.check(RegularError):
+                    fail.printTraceback()
                 if not self._firstError:
-                    self._firstError = (failure, item)
-                self._lastResult = [False, failure, item]
-                self._results.append(self._lastResult)
+                    self._firstError = (fail, item)
+                self._lastResult = [False, fail, item]
                 if self._stopOnFailure:
-                    raise
-                    #yield self._results
-                    #return
-                    
+                    stopFailure = failure.Failure()
+
+            if self._resultHandler:
+                wfd = waitForDeferred(defer.maybeDeferred(self._resultHandler, *self._lastResult))
+                yield wfd
+                wfd.getResult()
+            else:
+                self._results.append(self._lastResult)
+            if stopFailure:
+                stopFailure.raiseException()
+
         yield self._results
 
+    def __iter__(self):
+        # self._items may be exchanged by stop() while iterating
+        while True:
+            try:
+                yield next(self._items)
+            except StopIteration:
+                return
+
+    def _runConcurrent(self):
+        self._contextId = getCurrentContextId()
+        self._inFlight = 0
+        self._filling = False
+        self._finished = defer.Deferred()
+        self._fill()
+        return self._finished
+
+    def _fill(self):
+        if self._filling: # work finished synchronously. the loop below will continue
+            return
+        self._filling = True
+        try:
+            while self._inFlight < self._concurrency and not self._finished.called:
+                try:
+                    item = next(self._items)
+                except StopIteration:
+                    break
+                if self._resultHandler:
+                    index = None
+                else:
+                    index = len(self._results)
+                    self._results.append(None) # reserve place to keep results in items order
+                self._inFlight += 1
+                setCurrentContext(self._contextId)
+                self._call(item).addBoth(self._workFinished, index, item)
+        except Exception as e: # broken items generator
+            self._finished.errback(getFailureFor(e))
+        finally:
+            self._filling = False
+        if not self._inFlight and not self._finished.called:
+            setCurrentContext(self._contextId)
+            self._finished.callback(self._results)
+
+    def _workFinished(self, result, index, item):
+        setCurrentContext(self._contextId)
+        stop = False
+        if isinstance(result, failure.Failure):
+            self._success = False
+            unexpected = not result.check(RegularError)
+            f = getFailureFor(result)
+            if unexpected:
+                f.printTraceback()
+            if not self._firstError:
+                self._firstError = (f, item)
+            self._lastResult = [False, f, item]
+            stop = self._stopOnFailure
+        else:
+            self._successCount += 1
+            self._lastResult = [True, result, item]
+
+        if self._resultHandler:
+            d = defer.maybeDeferred(self._resultHandler, *self._lastResult)
+        else:
+            self._results[index] = self._lastResult
+            d = defer.succeed(None)
+        d.addBoth(self._resultHandled, self._lastResult if stop else None)
+
+    def _resultHandled(self, result, stopResult):
+        self._inFlight -= 1
+        setCurrentContext(self._contextId)
+        if self._finished.called:
+            return
+        if isinstance(result, failure.Failure):
+            self._finished.errback(result)
+        elif stopResult:
+            self._finished.errback(stopResult[1])
+        else:
+            self._fill()
+
     def stop(self):
-        self._items = []
-        
+        self._items = iter([])
+
     def isSuccess(self):
         return self._success
     
@@ -137,7 +307,7 @@ class DQueue(object):
 #
 # its very similar to deferred queue (DQueue) but have no finish callback
 # and will call setted callback or errback for each element
-class ActionQueueItem:
+class ActionQueueItem(object):
     def __init__(self, func, args, kwargs):
         self.func = func
         self.args = args
@@ -146,12 +316,47 @@ class ActionQueueItem:
         self.defer = None
         self.contextId = None
         self.active = False
+        self.priority = 0
+        self.queuedAt = None
+        self.queue = None
+        self._entry = None # cell of queue's lane. see ActionQueue._push
+        self._lane = None
+        self.leader = None # queued item this one was coalesced into
+        self._followers = []
+        self.failed = False
         
     def setIdentifier(self, i):
         """
         Identifier allows search and clean this item in the queue
         """
-        self.identifier = i
+        if self._entry:
+            self.queue._unindex(self)
+            self.identifier = i
+            self.queue._index(self)
+            if self.queue._coalescing:
+                self.queue._coalesce(self)
+        else:
+            self.identifier = i
+        return self
+
+    def setPriority(self, priority):
+        """
+        Items with higher priority are executed first. Default priority is 0.
+
+        Already queued item goes to the end of its new priority lane.
+        Coalesced item raises priority of the item it was merged into.
+        """
+        if self.leader:
+            if priority > self.leader.priority:
+                self.leader.setPriority(priority)
+            self.priority = priority
+        elif priority != self.priority and self._entry:
+            queue = self.queue
+            queue._remove(self)
+            self.priority = priority
+            queue._push(self)
+        else:
+            self.priority = priority
         return self
         
     def getDeferred(self):
@@ -160,25 +365,33 @@ class ActionQueueItem:
         return self.defer
     
     def toTop(self):
-        self.queue.moveToTop(self)
+        if self.leader:
+            self.leader.toTop()
+        else:
+            self.queue.moveToTop(self)
     
     def saveContext(self):
         self.contextId = getCurrentContextId()
         return self
     
-    def invoke(self, defualtCallback, defaultErrback):
-        from rcore import Core
-        if Core.instance().debugEnabled():
-            print("ActionQueue: Executing job from queue: " + str(self.func))
+    def invoke(self, defualtCallback, defaultErrback, executor=None):
+        if debug.enabled:
+            debug.trace("ActionQueue: Executing job from queue: " + str(self.func))
         self.active = True
-        d = defer.maybeDeferred(self.func, *self.args, **self.kwargs)
+        if executor:
+            d = executor.run(self.func, *self.args, **self.kwargs)
+        else:
+            d = defer.maybeDeferred(self.func, *self.args, **self.kwargs)
+        d.addBoth(self._setOutcome)
+        if self._followers:
+            d.addBoth(self._notifyFollowers)
         if self.defer:
-            if Core.instance().debugEnabled():
-                print("ActionQueue: adding own callback")
+            if debug.enabled:
+                debug.trace("ActionQueue: adding own callback")
             d.addCallbacks(self.defer.callback, self.defer.errback)
         else:
-            if Core.instance().debugEnabled():
-                print("ActionQueue: adding default callback")
+            if debug.enabled:
+                debug.trace("ActionQueue: adding default callback")
             d.addCallbacks(defualtCallback, defaultErrback)
         return d
             
@@ -188,25 +401,180 @@ class ActionQueueItem:
 
          False means this item still wait in the queue
         """
+        if self.leader:
+            return self.leader.isActive()
         return self.active
 
+    def _setOutcome(self, result):
+        self.failed = isinstance(result, failure.Failure)
+        return result
+
+    def _follow(self, leader):
+        self.leader = leader
+        leader._followers.append(self)
+        for follower in self._followers:
+            follower._follow(leader)
+        self._followers = []
+
+    def _failFollowers(self, f):
+        """Fails items merged into this one when it leaves the queue without execution"""
+        followers, self._followers = self._followers, []
+        for follower in followers:
+            follower.leader = None
+            if follower.defer:
+                follower.defer.errback(f)
+
+    def _notifyFollowers(self, result):
+        for follower in self._followers:
+            if follower.defer:
+                if isinstance(result, failure.Failure):
+                    follower.defer.errback(result)
+                else:
+                    follower.defer.callback(result)
+        return result
+
+
+class _Lane(object):
+    """
+    FIFO of ActionQueue items with the same priority (or of items parked until their key is free).
 
-class ActionQueue(list):
+    Items are kept in one-element cells. Removed or moved item just empties its cell.
+    """
+    __slots__ = ("cells", "size", "stale", "parkKey")
+
+    def __init__(self, parkKey=None):
+        self.cells = collections.deque()
+        self.size = 0
+        self.stale = 0
+        self.parkKey = parkKey
+
+    def head(self):
+        cells = self.cells
+        while cells[0][0] is None:
+            cells.popleft()
+            self.stale -= 1
+        return cells[0][0]
+
+    def compact(self):
+        if self.stale > 1024 and self.stale > self.size:
+            self.cells = collections.deque(cell for cell in self.cells if cell[0] is not None)
+            self.stale = 0
+
+
+class ActionQueue(object):
     """
     It's more like endless queue.
 
     it sleeps while queue is empty and execute some action when it's queued
+
+    Items are executed in order of their priority (see ActionQueueItem.setPriority)
+    and in FIFO order inside each priority. Removing, moving and lookups by identifier cost O(1).
+
+    By default one item is executed at a time. With setConcurrency(n) up to n items are executed
+    simultaneously, but items with the same identifier are still executed one by one in queue order.
+
+    Queue size is unlimited by default. See setCapacity for limits and overflow policies.
+
+    Wait time, execution time, depth and throughput are available with stats().
+
+    In coalescing mode (see setCoalescing) item with identifier of already waiting item is merged
+    into the waiting one. The merged item is executed once and all their deferreds get its result.
     """
-    def __init__(self, *args, **kwargs):
+    OverflowReject = 1 # raise QueueOverflowError
+    OverflowDropOldest = 2 # drop oldest item of the lowest priority to free space
+    OverflowCoalesce = 3 # return already queued item with the same identifier or reject
+    def __init__(self, items=()):
         """
-        Constructor accepts standard for `list` args
+        @param items: iterable of ActionQueueItem to enqueue
         """
-        list.__init__(self, *args, **kwargs)
+        self._lanes = {} # priority -> _Lane
+        self._priorities = [] # sorted priorities of not empty lanes
+        self._identifiers = {} # identifier -> OrderedDict of pending items with this identifier (as keys)
+        self._size = 0
+        self._aging = None
+        self._concurrency = 1
+        self._running = 0
+        self._busyKeys = set() # identifiers of executing items
+        self._parked = {} # identifier -> _Lane of items waiting for executing item with the same identifier
+        self._maxSize = None
+        self._lowWatermark = None
+        self._overflowPolicy = self.OverflowReject
+        self._throttled = False # max size was reached and queue didn't drain to low watermark yet
+        self._capacityWaiters = collections.deque()
+        self._coalescing = False
+        self._merge = None
+        self._executor = None
+        self._stats = stats.QueueStats()
         self._errback = self._callback = lambda result: result
         self.active = False;
-        self.checkPlanned = False
+        self.checkPlanned = False # queue has work, see waitForFinish
+        self._checkPending = False # checkQueue call is scheduled
         self.finishWaiter = None
-        
+        for item in items:
+            self._push(item)
+        if self._size:
+            self._planCheck()
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        for priority in reversed(self._priorities[:]):
+            for cell in list(self._lanes[priority].cells):
+                if cell[0] is not None:
+                    yield cell[0]
+        for lane in self._parked.values():
+            for cell in list(lane.cells):
+                if cell[0] is not None:
+                    yield cell[0]
+
+    def setConcurrency(self, limit):
+        """
+        Sets max number of simultaneously executed items.
+
+        Items with the same not None identifier are never executed simultaneously.
+        @param limit: int number of workers. 1 means one by one (default)
+        """
+        if int(limit) < 1:
+            raise InvalidParametersError("ActionQueue concurrency must be positive")
+        self._concurrency = int(limit)
+        if self._size:
+            self._planCheck()
+
+    def setName(self, name):
+        """
+        Registers queue statistics under passed name (see rcore.stats.collect("queue"))
+        """
+        stats.register("queue", name, self)
+
+    def stats(self):
+        """
+        @return: dict with depth, wait and execution time histograms, throughput and failures
+        """
+        return self._stats.toDict(self._size)
+
+    def setExecutor(self, kind=None, size=4):
+        """
+        Makes actions executed in thread or process pool instead of reactor thread.
+
+        Use setConcurrency to execute more than one action of the queue at a time.
+        @param kind: "thread", "process" or None to execute in reactor thread (default)
+        @param size: int pool size
+        """
+        from rcore.executor import getExecutor
+        self._executor = getExecutor(kind, size) if kind else None
+
+    def setAging(self, interval=None):
+        """
+        Protects low priority items from starvation.
+
+        Each `interval` seconds of waiting raise item's priority by one when next item is chosen.
+        @param interval: float seconds or None to disable aging (default)
+        """
+        if interval is not None and interval <= 0:
+            raise InvalidParametersError("aging interval must be positive")
+        self._aging = interval
+
     def append(self, func, *args, **kwargs):
         """
         Enqueue some action `func`.
@@ -218,26 +586,256 @@ class ActionQueue(list):
         @param kwargs: dict of kwargs for callable
         @return: ActionQueueItem
         """
-        from rcore import Core
-        if Core.instance().debugEnabled():
-            print("ActionQueue: Adding job to queue: " + str(func))
-        item = ActionQueueItem(func, args, kwargs)
-        list.append(self, item)
-        if not self.checkPlanned:
-            self.checkPlanned = True
-            if Core.instance().debugEnabled():
-                print("ActionQueue: Planning check queue")
+        return self.appendItem(ActionQueueItem(func, args, kwargs))
+
+    def appendItem(self, item):
+        """
+        Enqueue already prepared ActionQueueItem.
+
+        Unlike append it allows to set identifier and priority before overflow policy is applied.
+        @param item: ActionQueueItem
+        @return: passed ActionQueueItem. Coalesced item gets result of the item it was merged into.
+                 With OverflowCoalesce policy already queued item is returned instead of rejected one
+        """
+        if debug.enabled:
+            debug.trace("ActionQueue: Adding job to queue: " + str(item.func))
+        if self._coalescing and self._coalesce(item):
+            return item
+        if self._maxSize is not None and self._size >= self._maxSize:
+            queued = self._overflow(item)
+            if queued is not None:
+                return queued
+        self._push(item)
+        self._stats.enqueued += 1
+        if self._size > self._stats.peakDepth:
+            self._stats.peakDepth = self._size
+        if self._maxSize is not None and self._size >= self._maxSize:
+            self._throttled = True
+        self._planCheck()
+        return item
+
+    def appendWhenReady(self, func, *args, **kwargs):
+        """
+        Enqueue action when queue has free space. Producers should prefer it to append on bounded queue.
+
+        @return: Deferred fired with ActionQueueItem when it's queued
+        """
+        if self._hasRoom():
+            return defer.succeed(self.append(func, *args, **kwargs))
+        d = self.waitForCapacity()
+        d.addCallback(lambda result: self.appendWhenReady(func, *args, **kwargs))
+        return d
+
+    def setCapacity(self, maxSize=None, policy=OverflowReject, lowWatermark=None):
+        """
+        Limits number of waiting (not executing) items.
+
+        maxSize is a high watermark. When it's reached, appended items are handled by overflow policy
+        and waitForCapacity waiters wait until queue drains to low watermark.
+        @param maxSize: int max number of waiting items or None for unlimited queue
+        @param policy: one of Overflow* constants
+        @param lowWatermark: int queue size to resume waiting producers at. 3/4 of maxSize by default
+        """
+        if maxSize is not None:
+            maxSize = int(maxSize)
+            if maxSize < 1:
+                raise InvalidParametersError("ActionQueue max size must be positive")
+            lowWatermark = maxSize * 3 // 4 if lowWatermark is None else int(lowWatermark)
+            if not 0 <= lowWatermark < maxSize:
+                raise InvalidParametersError("low watermark must be less than max size")
+        if policy not in (self.OverflowReject, self.OverflowDropOldest, self.OverflowCoalesce):
+            raise InvalidParametersError("Unknown ActionQueue overflow policy")
+        self._maxSize = maxSize
+        self._lowWatermark = lowWatermark
+        self._overflowPolicy = policy
+        self._throttled = maxSize is not None and self._size >= maxSize
+        self._releaseWaiters()
+
+    def setCoalescing(self, enabled=True, merge=None):
+        """
+        Turns on merging of items with the same identifier while they wait in the queue.
+
+        Identifier may be set either before appendItem or right after append.
+        @param enabled: bool on/off coalescing
+        @param merge: Callable like merge(waitingItem, newItem) returning item which func and args
+                      should be executed. By default waiting item is executed as is
+        """
+        self._coalescing = enabled
+        self._merge = merge if hasattr(merge, "__call__") else None
+
+    def _coalesce(self, item):
+        """
+        Merges item into waiting item with the same identifier if any.
+
+        @return: bool True if item was merged
+        """
+        items = self._identifiers.get(item.identifier) if item.identifier is not None else None
+        if not items:
+            return False
+        leader = next(iter(items))
+        if leader is item:
+            return False
+        if item._entry:
+            self._remove(item)
+        if self._merge:
+            winner = self._merge(leader, item)
+            if winner is item:
+                leader.func, leader.args, leader.kwargs = item.func, item.args, item.kwargs
+        item._follow(leader)
+        self._stats.coalesced += 1
+        return True
+
+    def isFull(self):
+        return self._maxSize is not None and self._size >= self._maxSize
+
+    def waitForCapacity(self):
+        """
+        Returns Deferred which is fired when queue is ready to accept new items.
+
+        @return: Deferred
+        """
+        if self._hasRoom():
+            return defer.succeed(None)
+        d = defer.Deferred(lambda d: self._capacityWaiters.remove(d))
+        self._capacityWaiters.append(d)
+        return d
+
+    def _hasRoom(self):
+        return self._maxSize is None or (not self._throttled and self._size < self._maxSize)
+
+    def _releaseWaiters(self):
+        if self._throttled and self._size <= self._lowWatermark:
+            self._throttled = False
+        while self._capacityWaiters and self._hasRoom():
+            self._capacityWaiters.popleft().callback(None)
+
+    def _overflow(self, item):
+        """
+        Applies overflow policy to item which doesn't fit into full queue.
+
+        @return: ActionQueueItem to return instead of passed one or None to enqueue passed item
+        """
+        if self._overflowPolicy == self.OverflowCoalesce and item.identifier is not None:
+            items = self._identifiers.get(item.identifier)
+            if items:
+                self._stats.coalesced += 1
+                return next(iter(items))
+        elif self._overflowPolicy == self.OverflowDropOldest and self._priorities:
+            oldest = self._lanes[self._priorities[0]].head()
+            self._remove(oldest)
+            self._stats.dropped += 1
+            f = QueueOverflowError("Dropped from overflowed queue: " + str(oldest.func)).toFailure()
+            if oldest.defer:
+                oldest.defer.errback(f)
+            else:
+                self._errback(f)
+            oldest._failFollowers(f)
+            return None
+        self._stats.rejected += 1
+        raise QueueOverflowError("ActionQueue is full (%d items)" % self._size)
+
+    def _planCheck(self):
+        self.checkPlanned = True
+        # busy workers check the queue themselves when they finish
+        if not self._checkPending and self._running < self._concurrency:
+            self._checkPending = True
+            if debug.enabled:
+                debug.trace("ActionQueue: Planning check queue")
             reactor.callLater(0, self.checkQueue)
+
+    def _push(self, item, toFront=False, lane=None):
+        if lane is None:
+            lane = self._lanes.get(item.priority)
+            if lane is None:
+                lane = self._lanes[item.priority] = _Lane()
+                bisect.insort(self._priorities, item.priority)
+        cell = [item]
+        item.queue = self
+        item._entry = cell
+        item._lane = lane
+        if item.queuedAt is None:
+            item.queuedAt = time.time()
+        if toFront:
+            lane.cells.appendleft(cell)
+        else:
+            lane.cells.append(cell)
+        lane.size += 1
+        self._size += 1
+        self._index(item)
+
+    def _remove(self, item):
+        self._unindex(item)
+        item._entry[0] = None
+        item._entry = None
+        self._size -= 1
+        lane = item._lane
+        item._lane = None
+        lane.size -= 1
+        lane.stale += 1
+        if lane.size:
+            lane.compact()
+        elif lane.parkKey is not None:
+            del self._parked[lane.parkKey]
+        else:
+            del self._lanes[item.priority]
+            del self._priorities[bisect.bisect_left(self._priorities, item.priority)]
+
+    def _pop(self):
+        if not self._priorities:
+            return None
+        if self._aging is None or len(self._priorities) == 1:
+            item = self._lanes[self._priorities[-1]].head()
+        else:
+            now = time.time()
+            item = None
+            for priority in self._priorities:
+                head = self._lanes[priority].head()
+                score = priority + (now - head.queuedAt) / self._aging
+                if item is None or score >= bestScore:
+                    item, bestScore = head, score
+        self._remove(item)
         return item
-        
-    def checkQueue(self):
-        from rcore import Core
-        
+
+    def _index(self, item):
+        if item.identifier is not None:
+            items = self._identifiers.get(item.identifier)
+            if items is None:
+                items = self._identifiers[item.identifier] = collections.OrderedDict()
+            items[item] = None
+
+    def _unindex(self, item):
+        items = self._identifiers.get(item.identifier)
+        if items is not None:
+            items.pop(item, None)
+            if not items:
+                del self._identifiers[item.identifier]
+
+    def _park(self, item):
+        lane = self._parked.get(item.identifier)
+        if lane is None:
+            lane = self._parked[item.identifier] = _Lane(item.identifier)
+        self._push(item, lane=lane)
+
+    def _start(self, item, key):
+        self._running += 1
+        self.active = True
+        self._run(item, key)
+
+    def _run(self, item, key):
         def finished(result, item):
-            if Core.instance().debugEnabled():
-                print("ActionQueue: job finished: " + str(result))
-            
-            self.active = False;
+            if debug.enabled:
+                debug.trace("ActionQueue: job finished: " + str(result))
+
+            self._stats.finished(time.time() - startedAt, item.failed)
+            lane = self._parked.get(key) if key is not None else None
+            if lane is None:
+                self._running -= 1
+                self.active = self._running > 0
+                self._busyKeys.discard(key)
+            else: # next item with the same key takes the worker over
+                nextItem = lane.head()
+                self._remove(nextItem)
+                reactor.callLater(0, self._run, nextItem, key)
             reactor.callLater(0, self.checkQueue)
             if item.contextId:
                 try:
@@ -251,17 +849,30 @@ class ActionQueue(list):
             #from rcore import Context
             #print "GARBAGE: ", gc.garbage, gc.get_referrers([a for a in gc.get_objects() if isinstance(a, Context)][-1])
             #return result
-        
-        
-        if Core.instance().debugEnabled():
-            print("ActionQueue: Checking queue: " + (str(len(self)) + " jobs" if len(self) else "empty"))
-            
-        if len(self):
-            if not self.active:
-                self.active = True
-                item = self.pop(0)
-                item.invoke(self._callback, self._errback).addBoth(finished, item)
-        else:
+
+        startedAt = time.time()
+        self._stats.started(startedAt - item.queuedAt)
+        item.invoke(self._callback, self._errback, self._executor).addBoth(finished, item)
+
+    def checkQueue(self):
+        if debug.enabled:
+            debug.trace("ActionQueue: Checking queue: " + (str(len(self)) + " jobs" if len(self) else "empty"))
+
+        self._checkPending = False
+        while self._running < self._concurrency:
+            item = self._pop()
+            if item is None:
+                break
+            key = item.identifier if self._concurrency > 1 else None
+            if key is not None:
+                if key in self._busyKeys:
+                    self._park(item)
+                    continue
+                self._busyKeys.add(key)
+            self._start(item, key)
+
+        self._releaseWaiters()
+        if not len(self) and not self._running:
             self.checkPlanned = False
             if self.finishWaiter:
                 d = self.finishWaiter
@@ -276,26 +887,33 @@ class ActionQueue(list):
         
     def findByIdentifier(self, id):
         id = id if isinstance(id, (list, tuple, set)) else set([id])
-        for i in self:
-            if i.identifier in id: return i
+        for i in id:
+            items = self._identifiers.get(i)
+            if items:
+                return next(iter(items))
         return False
     
     def cleanByIdentifier(self, id):
+        """
+        Removes waiting items with passed identifier(s). Removed items are not fired,
+        but items coalesced into them are failed with CancelledError.
+        """
         id = id if isinstance(id, (list, tuple, set)) else set([id])
-        i = 0
-        while i < len(self):
-            if self[i].identifier in id and not self[i].isActive():
-                del self[i]
-            else:
-                i += 1
+        for i in id:
+            for item in self._identifiers.pop(i, ()): # whole entry at once, so _remove has nothing to unindex
+                self._remove(item)
+                if item._followers:
+                    item._failFollowers(failure.Failure(defer.CancelledError("Removed from queue: " + str(item.func))))
+        self._releaseWaiters()
     
     def moveToTop(self, item):
-        for i in xrange(len(self)):
-            if self[i] == item:
-                del self[i] # nothing bad if its already 0th item
-                self.insert(0, item)
-                return
-        raise InternalError("Can't move to top not existent ActionQueueItem")
+        """
+        Moves item to the head of its priority lane
+        """
+        if item.queue is not self or not item._entry:
+            raise InternalError("Can't move to top not existent ActionQueueItem")
+        self._remove(item)
+        self._push(item, toFront=True)
     
     def waitForFinish(self):
         """
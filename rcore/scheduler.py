@@ -25,48 +25,351 @@
 
 from __future__ import absolute_import
 
+import calendar
 import collections
+import heapq
+import itertools
+import math
+import random
+import time as _time
+import zlib
 from datetime import datetime, timedelta, date, time
 #import sched, time
 from twisted.internet import defer, reactor
 from twisted.python import failure, log
 
+from rcore import stats
+from rcore.config import config
+from rcore.cron import CronExpression, getTimezone
 from rcore.error import SchedulerError, InternalError
-from rcore.context import executeInExactContext, getContext, Context
+from rcore.context import executeInExactContext, getContext, Context, makeContext, setCurrentContext, deleteContext
+from rcore.executor import getExecutor, createExecutor, THREAD, PROCESS
+from rcore.lease import defaultOwner
 
 STATE_PAUSED = 0
 STATE_DELAY = 1
 STATE_WORK = 2
 
+STATE_NAMES = {STATE_PAUSED: "paused", STATE_DELAY: "delay", STATE_WORK: "work"}
+
+REPEAT_FIXED_RATE = 1 # next run is planned from previous planned time
+REPEAT_FIXED_DELAY = 2 # next run is planned from the end of previous run
+
+CLOCK_WALL = 1 # job follows datetime.now() (keeps local time of daily jobs over DST)
+CLOCK_MONOTONIC = 2 # job follows scheduler's monotonic timeline only
+
+# what fixed rate job does with runs missed while reactor was busy
+CATCHUP_SKIP = 1 # continue from next future time
+CATCHUP_ONCE = 2 # run once for all missed times
+CATCHUP_ALL = 3 # run each missed time (up to a limit of latest ones) one after another
+
+JITTER_RANDOM = 1 # new random delay for each run
+JITTER_HASH = 2 # stable delay derived from job's key, survives restarts
+
+
+def _monotonicClock():
+    """
+    Finds best available monotonic clock function.
+    time.monotonic if exists, clock_gettime(CLOCK_MONOTONIC) on Linux and time.time as a last resort
+    """
+    if hasattr(_time, "monotonic"):
+        return _time.monotonic
+    try:
+        import ctypes, ctypes.util
+
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1", use_errno=True)
+        clock_gettime = librt.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC_ID = 1
+        ts = timespec()
+
+        def monotonic():
+            if clock_gettime(CLOCK_MONOTONIC_ID, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        monotonic()
+        return monotonic
+    except Exception:
+        return _time.time
+
+
+monotonic = _monotonicClock()
+
+
+def _toSeconds(delay):
+    return delay.total_seconds() if isinstance(delay, timedelta) else float(delay)
+
+
+def _hashKey(key):
+    """Hash of string which is the same on all nodes and restarts"""
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return zlib.crc32(key) & 0xffffffff
+
+
+def _poolSize(kind):
+    """Size of job's pool from config (scheduler.pool.thread / scheduler.pool.process), 4 by default"""
+    try:
+        return max(1, int(config()['scheduler']['pool'][kind]))
+    except Exception:
+        return 4
+
+
+_pools = {} # kind -> executor sized by config, shared by jobs without explicit pool size
+
+
+def _configuredPool(kind):
+    if kind not in _pools:
+        if not _pools:
+            config.connect("changed", _resizePools)
+        _pools[kind] = createExecutor(kind, _poolSize(kind))
+    return _pools[kind]
+
+
+def _resizePools(sender):
+    for kind, executor in _pools.items():
+        executor.resize(_poolSize(kind))
+
+
+def _alarm(message):
+    """Notifies alarm service. Scheduler keeps working if there is no such service or it fails"""
+    from rcore import Core
+    try:
+        Core.instance().getRPCService("alarm").notify(message, ["error"])
+    except Exception:
+        log.msg("Unable to send alarm: " + message)
+        log.err()
+
+
+def _runContext(constructor):
+    """Executed in worker process. Creates context there and runs it"""
+    contextId = makeContext(constructor)
+    setCurrentContext(contextId)
+    try:
+        result = getContext().run()
+    finally:
+        deleteContext(contextId)
+    if isinstance(result, defer.Deferred):
+        raise SchedulerError("Context executed in process pool must return its result synchronously")
+    return result
+
+_jobIds = itertools.count(1)
+
 
 class SchedulerJob(object):
     def __init__(self, job, *args):
+        self.id = next(_jobIds)
+        self.name = None
         self.job = job
         self.args = args
         self.repeatedDelay = None
+        self.repeatMode = REPEAT_FIXED_RATE
+        self.catchUp = CATCHUP_SKIP
+        self.catchUpLimit = None
+        self.clock = CLOCK_WALL
         self.timeHandler = None
         self.time = None
+        self.due = None # planned time on scheduler's timeline
+        self.phase = 0 # fixed offset in seconds added to each planned time
+        self.jitter = None # (max delay in seconds, mode, key) or None to use scheduler's default
+        self.resources = () # names of scheduler's resources job holds while working
+        self.executorKind = None
+        self.executorSize = None
+        self.singleton = None # lease ttl in seconds or True for default one
+        self.sharded = False
+        self.blockedRetries = 0
         self.result = None
         self.state = STATE_PAUSED
         self.pauseRequested = False
         self.maxExecTime = timedelta(minutes=10)
         self.currentDeferred = None
         self.timeoutDC = None
+        self._stats = stats.JobStats(scheduler._stats)
+        self._plannedAt = None
+        self._startedAt = None
+
+    def setName(self, name):
+        """Name of the job in statistics"""
+        self.name = name
+        return self
+
+    def getName(self):
+        return self.name or "%s#%d" % (getattr(self.job, "__name__", self.job.__class__.__name__), self.id)
+
+    def stats(self):
+        """
+        @return: dict with run counters, lag and duration histograms (seconds), state and next fire time
+        """
+        ret = self._stats.toDict()
+        planned = self.state == STATE_DELAY and self.timeHandler and self.timeHandler.active()
+        ret.update(state=STATE_NAMES[self.state], nextFireTime=self.time.isoformat() if planned else "")
+        return ret
 
     def isWorking(self):
         return self.state == STATE_WORK
 
-    def repeated(self, delay):
-        if type(delay) == timedelta:
-            self.repeatedDelay = delay
-        if type(delay) == int:
+    def isRepeated(self):
+        return self.repeatedDelay is not None
+
+    def repeated(self, delay, mode=REPEAT_FIXED_RATE):
+        """
+        Makes job periodic.
+
+        @param delay: period as timedelta, seconds (int or float) or "hh:mm:ss" string
+        @param mode: REPEAT_FIXED_RATE keeps runs on a fixed grid of planned times,
+                     REPEAT_FIXED_DELAY waits the period after each run is finished
+        """
+        if isinstance(delay, (int, float)):
             self.repeatedDelay = timedelta(seconds=delay)
         else:
             self.repeatedDelay = self._convertDelay(delay)
-        if self.repeatedDelay < timedelta(seconds=1):
+        if self.repeatedDelay < timedelta(milliseconds=1):
             raise Exception("period too small!")
+        self.repeatMode = mode
         return self
 
+    def setCatchUp(self, policy, limit=None):
+        """
+        Sets what fixed rate job does with runs missed while reactor was busy or job was working too long.
+        Job's time attribute keeps planned time of current run, so job may find out which interval it handles.
+
+        @param policy: CATCHUP_SKIP (default), CATCHUP_ONCE or CATCHUP_ALL
+        @param limit: for CATCHUP_ALL max number of latest missed runs to execute, older ones are skipped
+        """
+        self.catchUp = policy
+        self.catchUpLimit = limit
+        return self
+
+    def setClock(self, clock):
+        """
+        Selects clock job follows. CLOCK_MONOTONIC makes job immune to system time changes
+        and is preferable for short periods. CLOCK_WALL (default) keeps legacy behaviour.
+        """
+        self.clock = clock
+        return self
+
+    def setJitter(self, maxDelay, mode=JITTER_RANDOM, key=None):
+        """
+        Delays each run for up to maxDelay to avoid simultaneous start of many jobs.
+        Planned times are not affected so fixed rate jobs still don't drift.
+
+        @param maxDelay: timedelta or seconds, 0 disables jitter even if scheduler has default one
+        @param mode: JITTER_RANDOM or JITTER_HASH
+        @param key: string for JITTER_HASH. job function name and arguments by default
+        """
+        self.jitter = (_toSeconds(maxDelay), mode, key)
+        return self
+
+    def setExecutor(self, kind=None, size=None):
+        """
+        Makes job executed in thread or process pool instead of reactor thread.
+        Results, failures and timeouts are handled as usual, but timed out run keeps working in the pool.
+
+        @param kind: "thread", "process" or None to execute in reactor thread (default)
+        @param size: int pool size. if omitted job uses pool sized by config (scheduler.pool.<kind>)
+            which is resized on config change
+        """
+        if kind not in (None, THREAD, PROCESS):
+            raise SchedulerError("Unknown executor kind: " + str(kind))
+        self.executorKind = kind
+        self.executorSize = size
+        return self
+
+    def _run(self):
+        if not self.executorKind:
+            return defer.maybeDeferred(self.job, *self.args)
+        return self._getExecutor().run(self.job, *self.args)
+
+    def _getExecutor(self):
+        if self.executorSize:
+            return getExecutor(self.executorKind, self.executorSize)
+        return _configuredPool(self.executorKind)
+
+    def setMaxExecTime(self, maxExecTime):
+        """
+        Run is cancelled if it's not finished within maxExecTime.
+
+        @param maxExecTime: timedelta or seconds. None disables timeout
+        """
+        self.maxExecTime = maxExecTime
+        return self
+
+    def requireResources(self, *names):
+        """
+        Declares resources job needs. Job is started only when all of them are available
+        (see Scheduler.setResourceLimit) otherwise job's on block action is applied.
+        """
+        self.resources = names
+        return self
+
+    def setPhase(self, offset):
+        """
+        @param offset: timedelta or seconds added to each planned time
+        """
+        self.phase = _toSeconds(offset)
+        return self
+
+    def _offset(self):
+        maxDelay, mode, key = self.jitter or scheduler.jitter
+        if not maxDelay:
+            return self.phase
+        if mode == JITTER_HASH:
+            return self.phase + _hashKey(key or self._stableKey()) % 1000 * maxDelay / 1000.0
+        return self.phase + random.uniform(0, maxDelay)
+
+    def _stableKey(self):
+        """Job's key which is the same on all nodes and restarts"""
+        return self.name or "%s.%s%r" % (getattr(self.job, "__module__", ""),
+                                         getattr(self.job, "__name__", self.job.__class__.__name__), self.args)
+
+    def setSingleton(self, ttl=None):
+        """
+        Makes only one node of the cluster run each occurrence of the job. Node acquires lease
+        for the occurrence from scheduler's lease store (see Scheduler.setLeaseStore) before each run.
+        Give job a name with setName and start repeated job at the same time on all nodes, so nodes agree
+        on occurrences.
+
+        @param ttl: timedelta or seconds lease is kept. maxExecTime by default
+        """
+        self.singleton = _toSeconds(ttl) if ttl is not None else True
+        return self
+
+    def setSharded(self, sharded=True):
+        """
+        Makes job run only on the node its name hash belongs to (see Scheduler.setSharding)
+        """
+        self.sharded = sharded
+        return self
+
+    def _leaseKey(self):
+        """Lease name of current occurrence"""
+        if self.time.tzinfo:
+            epoch = calendar.timegm(self.time.utctimetuple())
+        else:
+            epoch = _time.mktime(self.time.timetuple())
+        epoch += self.time.microsecond / 1e6
+        if self.repeatedDelay:
+            return "%s@%d/%d" % (self._stableKey(), int(round(epoch / self.repeatedDelay.total_seconds())),
+                                 int(self.repeatedDelay.total_seconds() * 1000))
+        return "%s@%d" % (self._stableKey(), int(round(epoch)))
+
+    def _leaseTtl(self):
+        if self.singleton is not True:
+            return self.singleton
+        return _toSeconds(self.maxExecTime) if self.maxExecTime else 600
+
+    def _delegate(self):
+        """Current occurrence is executed by another node"""
+        self._stats.count("delegated")
+        if self.isRepeated():
+            self._nextLoop()
+        else:
+            scheduler.removeJob(self)
+
     def start(self, startAt=None):
         self.state = STATE_DELAY
         now = datetime.now()
@@ -77,16 +380,16 @@ class SchedulerJob(object):
             self.time = startAt
         elif tt == time:
             self.time = datetime.combine(date.today(), startAt)
-        elif tt == int:
+        elif tt in (int, float):
             self.time = now + timedelta(seconds=startAt)
         elif tt == str: # we will consider this is time hh:mm:ss
             self.time = datetime.combine(date.today(), time()) + self._convertDelay(startAt)
         else:
             self.time = now
-        if self.time < now and not self.repeatedDelay:
+        if self.time < now and not self.isRepeated():
             raise InternalError("Invalid scheduler time")
-        td = self.time - now
-        self.timeHandler = reactor.callLater(td.days * 86400 + td.seconds, self._execute)
+        self.due = scheduler.seconds() + (self.time - now).total_seconds()
+        self._plan()
         return self
 
     def cancel(self):
@@ -116,38 +419,79 @@ class SchedulerJob(object):
 
     def resume(self):
         if self.state == STATE_PAUSED:
-            self._nextLoop()
+            if self.isRepeated():
+                self._nextLoop(catchUp=False) # pause is intentional, so nothing is missed
+            else:
+                self._plan() # one-shot job keeps its time, already passed one fires right away
+            self.state = STATE_DELAY
 
-    def _nextLoop(self):
+    def _nextLoop(self, catchUp=True):
         now = datetime.now()
-        while self.time - now < timedelta(seconds=1): # don't call too often or in past
-            self.time += self.repeatedDelay
-        td = self.time - now
-        self.timeHandler = reactor.callLater(td.days * 86400 + td.seconds, self._execute)
+        seconds = scheduler.seconds()
+        if self.clock == CLOCK_MONOTONIC:
+            period = self.repeatedDelay.total_seconds()
+            if self.repeatMode == REPEAT_FIXED_DELAY:
+                self.due = seconds + period
+            else: # planned times only, so no drift
+                self.due += self._advance(seconds - self.due, 0, catchUp)
+            self.time = now + timedelta(seconds=self.due - seconds)
+        else:
+            if self.repeatMode == REPEAT_FIXED_DELAY:
+                self.time = now + self.repeatedDelay
+            else:
+                # don't call too often, sub-second periods only skip past times
+                gap = 1 if self.repeatedDelay >= timedelta(seconds=1) else 0
+                self.time += timedelta(seconds=self._advance((now - self.time).total_seconds(), gap, catchUp))
+            self.due = seconds + (self.time - now).total_seconds()
+        self._plan()
 
-    def _execute(self):
-        def checkTimeout(d):
-            if d and not d.called:
-                from rcore import Core
+    def _advance(self, elapsed, gap, catchUp):
+        """
+        Computes next time of fixed rate job according to its catch up policy.
+
+        @param elapsed: seconds passed since previous planned time
+        @param gap: min seconds from now to next time if missed runs are skipped
+        @return: seconds from previous planned time to next one
+        """
+        period = self.repeatedDelay.total_seconds()
+        missed = int(elapsed // period) if catchUp and elapsed >= period else 0 # planned times already passed
+        if missed and self.catchUp == CATCHUP_ONCE:
+            self._stats.count("missed", missed - 1)
+            return missed * period
+        if missed and self.catchUp == CATCHUP_ALL:
+            skipped = max(missed - self.catchUpLimit, 0) if self.catchUpLimit else 0
+            self._stats.count("missed", skipped)
+            return (skipped + 1) * period
+        steps = max(int(math.floor((elapsed + gap) / period)) + 1, 0)
+        if catchUp and steps > 1:
+            self._stats.count("missed", steps - 1)
+        return steps * period
 
-                Core.instance().getRPCService("alarm").notify("Execution of %s was timed out. This usually mean "
-                                                              "that deferreds chain is corrupted or something just hangs and "
-                                                              "its definitelly a bad sign. notice if this a looped job next "
-                                                              "cycle will never be started" % repr(self), ["error"])
+    def _plan(self):
+        self._plannedAt = self.due + self._offset()
+        self.timeHandler = scheduler.callAt(self._plannedAt, scheduler._fire, self)
 
-        if scheduler.aboutToExecute(self) == False: # current execution cancelled
-            return defer.succeed(None)
+    def _execute(self):
         if self.state == STATE_WORK:
             raise SchedulerError("Can't execute. it's already executing")
+        if scheduler.aboutToExecute(self) == False: # current execution cancelled or delayed
+            return defer.succeed(None)
 
         def handleResult(result):
             """just stores last execution result"""
+            if self.currentDeferred is not d: # abandoned by timeout
+                return
+            if self.timeoutDC and self.timeoutDC.active():
+                self.timeoutDC.cancel()
+            self.timeoutDC = None
+            self._stats.finished(scheduler.seconds() - self._startedAt, isinstance(result, failure.Failure))
             self.result = result
             if isinstance(result, failure.Failure):
                 log.msg(result.getTraceback())
             self.state = STATE_DELAY
             self.currentDeferred = None
-            if not self.repeatedDelay:
+            scheduler.jobFinished(self)
+            if not self.isRepeated():
                 scheduler.removeJob(self)
             else:
                 if self.pauseRequested:
@@ -156,14 +500,28 @@ class SchedulerJob(object):
                 else:
                     self._nextLoop()
 
+        def checkTimeout():
+            self.timeoutDC = None
+            if self.currentDeferred is not d:
+                return
+            self._stats.count("timedOut")
+            d.cancel()
+            if self.currentDeferred is d: # cancellation was ignored, so just forget about this run
+                handleResult(failure.Failure(SchedulerError("Execution of %s timed out" % repr(self))))
+            _alarm("Execution of %s was timed out and cancelled. This usually mean that deferreds chain is "
+                   "corrupted or something just hangs and its definitelly a bad sign." % repr(self))
+
+        forced = self.timeHandler is not None and self.timeHandler.active()
         self.state = STATE_WORK
         self.startedAt = datetime.today()
+        self._startedAt = scheduler.seconds()
+        self._stats.started(None if forced or self._plannedAt is None else self._startedAt - self._plannedAt)
         self.timeHandler = None
-        self.currentDeferred = defer.maybeDeferred(self.job, *self.args)
-        self.currentDeferred.addBoth(handleResult)
-        reactor.callLater(self.maxExecTime.days * 86400 + \
-                          self.maxExecTime.seconds, checkTimeout, self.currentDeferred)
-        return self.currentDeferred
+        d = self.currentDeferred = self._run()
+        d.addBoth(handleResult) # may reset currentDeferred right here if job is synchronous
+        if self.currentDeferred is d and self.maxExecTime:
+            self.timeoutDC = scheduler.callLater(_toSeconds(self.maxExecTime), checkTimeout)
+        return d
 
     def _convertDelay(self, strTime):
         if isinstance(strTime, timedelta):
@@ -174,7 +532,7 @@ class SchedulerJob(object):
         exp.reverse()
         for v in names:
             if len(exp):
-                ret[v] = int(exp[0])
+                ret[v] = float(exp[0]) if v == "sec" else int(exp[0])
                 del exp[0]
             else:
                 break
@@ -186,79 +544,484 @@ class ContextedSchedulerJob(SchedulerJob):
         assert issubclass(context, Context) and isinstance(context.run, collections.Callable)
         super(ContextedSchedulerJob, self).__init__(lambda: executeInExactContext(lambda: getContext().run(), context),
                                                     *args)
+        self.context = context
+
+    def setExecutor(self, kind=None, size=None):
+        """
+        Only process pool is supported since contexts are not thread safe.
+        Context is created in worker process and its run() must return result synchronously.
+        """
+        if kind == THREAD:
+            raise SchedulerError("Contexted job can't be executed in thread pool")
+        return super(ContextedSchedulerJob, self).setExecutor(kind, size)
+
+    def _run(self):
+        if self.executorKind == PROCESS:
+            return self._getExecutor().run(_runContext, self.context)
+        return super(ContextedSchedulerJob, self)._run()
+
+
+class CronSchedulerJob(SchedulerJob):
+    """
+    Job fired by cron expression. Works with usual pause/resume/force/cancel.
+    """
+
+    def __init__(self, cron, job, *args):
+        super(CronSchedulerJob, self).__init__(job, *args)
+        self.cron = cron if isinstance(cron, CronExpression) else CronExpression(cron)
+        self.tz = None
+
+    def setTimezone(self, tz):
+        """
+        @param tz: tzinfo or time zone name (requires pytz). None means system local time
+        """
+        self.tz = getTimezone(tz)
+        return self
+
+    def isRepeated(self):
+        return True
+
+    def repeated(self, delay, mode=REPEAT_FIXED_RATE):
+        raise SchedulerError("Cron job can't be repeated with fixed period")
+
+    def start(self, startAt=None):
+        """
+        Plans first fire time strictly after startAt (datetime, now by default)
+        """
+        self.state = STATE_DELAY
+        self.time = startAt
+        self._nextLoop()
+        return self
+
+    def _nextLoop(self, catchUp=True):
+        now = datetime.now(self.tz) if self.tz else datetime.now()
+        after = now
+        if self.time and self.state != STATE_PAUSED:
+            after = max(now, self.time) # never fire same time twice
+        self.time = self.cron.next(after, self.tz)
+        self.due = scheduler.seconds() + (self.time - now).total_seconds()
+        self._plan()
+
+
+class _Timer(object):
+    """
+    Delayed call planned on Scheduler's timeline. Interface is similar to twisted's DelayedCall
+    """
+    __slots__ = ("time", "func", "args", "cancelled", "called", "scheduler")
+
+    def __init__(self, scheduler, when, func, args):
+        self.scheduler = scheduler
+        self.time = when
+        self.func = func
+        self.args = args
+        self.cancelled = False
+        self.called = False
+
+    def getTime(self):
+        return self.time
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.scheduler._timerCancelled()
 
 
 class Scheduler(object):
+    """
+    Keeps all jobs in id-indexed registry and drives all their timers
+    from a min-heap with a single reactor timer.
+    """
     SkipBlocked = 1
     RescheduleBlocked = 2
     QueueBlocked = 3
 
     def __init__(self):
-        self.scheduled = []
+        self.jobs = dict() # job id -> job
         self.blockers = dict()
         self.blockActions = dict()
+        self._timers = [] # heap of (time, seq, _Timer)
+        self._seq = itertools.count()
+        self._cancelled = 0 # cancelled timers still in heap
+        self._wakeup = None # reactor's DelayedCall for heap's head
+        self._wakeupAt = None
+        self.jitter = (0, JITTER_RANDOM, None) # default for jobs without own jitter
+        self._stats = stats.JobStats() # totals of all jobs
+        self.resourceLimits = dict() # resource name -> capacity
+        self.resourceUsage = collections.defaultdict(int)
+        self._heldResources = dict() # job id -> acquired resource names
+        self._waiting = collections.deque() # jobs queued by QueueBlocked action
+        self._waitingTimer = None
+        self.leaseStore = None
+        self.leaseOwner = None
+        self.shardIndex = 0
+        self.shardCount = 1
+        self.maxStartsPerTick = None
+        self.maxStartsPerSecond = None
+        self._tickStarts = 0
+        self._recentStarts = collections.deque() # start times within last second
+        self._startQueue = collections.deque() # jobs waiting for start limits
+        self._drainTimer = None
+
+    @property
+    def scheduled(self):
+        return list(self.jobs.values())
 
     def job(self, executor, *args):
         j = SchedulerJob(executor, *args)
-        self.scheduled.append(j)
+        self.jobs[j.id] = j
         return j
 
     def contextJob(self, context, *args):
         j = ContextedSchedulerJob(context, *args)
-        self.scheduled.append(j)
+        self.jobs[j.id] = j
         return j
 
+    def cronJob(self, cron, executor, *args, **kw):
+        """
+        Creates job fired by cron expression. Job still has to be started.
+
+        @param cron: cron expression string or CronExpression
+        @param tz: keyword only, time zone for cron expression
+        """
+        j = CronSchedulerJob(cron, executor, *args).setTimezone(kw.get("tz"))
+        self.jobs[j.id] = j
+        return j
+
+    def setJitter(self, maxDelay, mode=JITTER_RANDOM):
+        """
+        Default jitter for jobs which don't have own one. See SchedulerJob.setJitter
+        """
+        self.jitter = (_toSeconds(maxDelay), mode, None)
+
+    def spread(self, jobs, period=None):
+        """
+        Spreads jobs evenly across the period by phase offsets.
+
+        @param period: timedelta or seconds. period of first job by default
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return
+        period = _toSeconds(period if period is not None else jobs[0].repeatedDelay)
+        for i, job in enumerate(jobs):
+            job.setPhase(period * i / len(jobs))
+
+    def setLeaseStore(self, store, owner=None):
+        """
+        Sets store of leases for singleton jobs. Singleton jobs are executed as usual if there is no store.
+
+        @param store: rcore.lease.LeaseStore
+        @param owner: name of this node. host name and pid by default
+        """
+        self.leaseStore = store
+        self.leaseOwner = owner or defaultOwner()
+
+    def setSharding(self, index, count):
+        """
+        Sets position of this node among nodes sharing sharded jobs
+
+        @param index: this node's index from 0 to count - 1
+        @param count: number of nodes
+        """
+        if not 0 <= index < count:
+            raise SchedulerError("Invalid shard index %d of %d" % (index, count))
+        self.shardIndex = index
+        self.shardCount = count
+
+    def setStartLimit(self, perTick=None, perSecond=None):
+        """
+        Caps how many jobs may start at once. Jobs over the limit are started later in planned order.
+        force() is not limited.
+
+        @param perTick: max jobs started by one reactor wakeup
+        @param perSecond: max jobs started within any second
+        """
+        self.maxStartsPerTick = perTick
+        self.maxStartsPerSecond = perSecond
+
+    def getJob(self, jobId):
+        return self.jobs.get(jobId)
+
     def removeJob(self, job):
-        self.scheduled.remove(job)
+        self.jobs.pop(job.id, None)
 
     def stop(self):
-        for s in self.scheduled:
+        for s in list(self.jobs.values()):
             s.cancel()
+        if self._wakeup and self._wakeup.active():
+            self._wakeup.cancel()
+        self._wakeup = None
+        self._startQueue.clear()
+        self._waiting.clear()
+
+    def seconds(self):
+        """Current time of scheduler's timeline. It's monotonic and not affected by system time changes"""
+        return monotonic()
+
+    def callLater(self, delay, func, *args):
+        """
+        Plans func call after delay seconds. O(log n) for any number of planned calls.
+
+        @return: _Timer which can be cancelled
+        """
+        return self.callAt(self.seconds() + max(delay, 0), func, *args)
+
+    def callAt(self, when, func, *args):
+        """
+        Plans func call at given time of scheduler's timeline (see seconds())
+
+        @return: _Timer which can be cancelled
+        """
+        timer = _Timer(self, when, func, args)
+        heapq.heappush(self._timers, (timer.time, next(self._seq), timer))
+        if self._wakeupAt is None or timer.time < self._wakeupAt:
+            self._arm()
+        return timer
+
+    def _timerCancelled(self):
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._timers):
+            self._timers = [t for t in self._timers if not t[2].cancelled]
+            heapq.heapify(self._timers)
+            self._cancelled = 0
+
+    def _arm(self):
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+            self._cancelled -= 1
+        if not timers:
+            if self._wakeup and self._wakeup.active():
+                self._wakeup.cancel()
+            self._wakeup = self._wakeupAt = None
+            return
+        self._wakeupAt = timers[0][0]
+        delay = max(self._wakeupAt - self.seconds(), 0)
+        if self._wakeup and self._wakeup.active():
+            self._wakeup.reset(delay)
+        else:
+            self._wakeup = reactor.callLater(delay, self._tick)
+
+    def _tick(self):
+        self._wakeup = self._wakeupAt = None
+        self._tickStarts = 0
+        now = self.seconds()
+        timers = self._timers
+        due = []
+        while timers and timers[0][0] <= now:
+            timer = heapq.heappop(timers)[2]
+            if timer.cancelled:
+                self._cancelled -= 1
+            else:
+                due.append(timer)
+        for timer in due: # timers planned by these calls are handled on next tick
+            if timer.cancelled: # by one of previous calls
+                self._cancelled -= 1
+                continue
+            timer.called = True
+            try:
+                timer.func(*timer.args)
+            except Exception:
+                log.err(None, "Scheduler: unhandled error in timer call")
+        self._arm()
+
+    def _fire(self, job):
+        """Job's time has come. Checks the occurrence belongs to this node and starts job"""
+        if job.sharded and _hashKey(job._stableKey()) % self.shardCount != self.shardIndex:
+            job._delegate()
+            return
+        if not job.singleton or self.leaseStore is None:
+            self._startJob(job)
+            return
+
+        def acquired(success):
+            if job.id not in self.jobs or job.state != STATE_DELAY: # cancelled or paused meanwhile
+                return
+            if success:
+                self._startJob(job)
+            else:
+                job._delegate()
+
+        def failed(fail):
+            log.err(fail, "Scheduler: unable to acquire lease for %s" % repr(job))
+            return False
+
+        d = self.leaseStore.acquire(job._leaseKey(), self.leaseOwner, job._leaseTtl())
+        d.addErrback(failed)
+        d.addCallback(acquired)
+
+    def _startJob(self, job):
+        if self._startQueue or not self._mayStart():
+            self._startQueue.append(job)
+            self._scheduleDrain()
+            return
+        self._noteStart()
+        job._execute()
+
+    def _mayStart(self):
+        if self.maxStartsPerTick and self._tickStarts >= self.maxStartsPerTick:
+            return False
+        if self.maxStartsPerSecond:
+            recent = self._recentStarts
+            threshold = self.seconds() - 1
+            while recent and recent[0] <= threshold:
+                recent.popleft()
+            if len(recent) >= self.maxStartsPerSecond:
+                return False
+        return True
+
+    def _noteStart(self):
+        self._tickStarts += 1
+        if self.maxStartsPerSecond:
+            self._recentStarts.append(self.seconds())
+
+    def _scheduleDrain(self):
+        if self._drainTimer and self._drainTimer.active():
+            return
+        delay = 0 # next tick
+        if self.maxStartsPerSecond and len(self._recentStarts) >= self.maxStartsPerSecond:
+            delay = self._recentStarts[0] + 1 - self.seconds()
+        self._drainTimer = self.callLater(delay, self._drainStarts)
+
+    def _drainStarts(self):
+        self._drainTimer = None
+        while self._startQueue and self._mayStart():
+            job = self._startQueue.popleft()
+            if job.id in self.jobs and job.state == STATE_DELAY: # not cancelled or paused meanwhile
+                self._noteStart()
+                try:
+                    job._execute()
+                except Exception:
+                    log.err(None, "Scheduler: unhandled error in job start")
+        if self._startQueue:
+            self._scheduleDrain()
+
+    def stats(self):
+        """
+        @return: dict with totals of all jobs, per job statistics by job name and scheduler's queues
+        """
+        return dict(
+            total=self._stats.toDict(),
+            jobs=dict((j.getName(), j.stats()) for j in self.jobs.values()),
+            timers=len(self._timers) - self._cancelled,
+            waiting=len(self._waiting),
+            startLimited=len(self._startQueue)
+        )
+
+    def setResourceLimit(self, name, capacity):
+        """
+        Sets how many jobs requiring named resource may work simultaneously.
+        Resources without limit are not restricted.
+        """
+        self.resourceLimits[name] = capacity
 
     def setConcurrentBlock(self, jobs):
         for cj in jobs:
-            if id(cj) not in self.blockers:
-                self.blockers[id(cj)] = []
+            if cj.id not in self.blockers:
+                self.blockers[cj.id] = []
             for bj in jobs:
                 if bj != cj:
-                    self.blockers[id(cj)].append(bj)
+                    self.blockers[cj.id].append(bj)
 
     def setOnBlockAction(self, job, actionType, *args):
-        self.blockActions[id(job)] = dict(action=actionType, args=args)
+        """
+        Sets what to do when job is blocked by working job or exhausted resource.
+
+        SkipBlocked - skip this run
+        RescheduleBlocked [, delay=1, maxDelay=60, factor=2] - retry with exponential backoff
+        QueueBlocked [, limit=1] - start as soon as blocker finishes. up to limit runs of the job are queued,
+                                   others are skipped
+
+        Jobs blocked by resources are queued by default.
+        """
+        self.blockActions[job.id] = dict(action=actionType, args=args)
 
     def aboutToExecute(self, job):
         """
         its kinda signal from job to scheduler that job is going
-        to execute. Scheduler checks here for blockers and may delay
+        to execute. Scheduler checks here for blockers and resources and may delay
         or stop execution if necessary
         """
-        jid = id(job)
-        if jid not in self.blockers:
+        blocker = self._findBlocker(job)
+        if blocker is None:
+            self._acquire(job)
+            job.blockedRetries = 0
             return True
-        for j in self.blockers[jid]:
+        job._stats.count("blocked")
+        action = self.blockActions.get(job.id)
+        if action is None:
+            if isinstance(blocker, SchedulerJob):
+                self._skipBlocked(job)
+                _alarm("Execution of %s was blocked by currently working %s and no handlers for this case "
+                       "were set. This usually means architectural design flaw." % (repr(job), repr(blocker)))
+                return False
+            action = dict(action=self.QueueBlocked, args=())
+        if action['action'] == self.QueueBlocked:
+            limit = action['args'][0] if action['args'] else 1
+            if sum(1 for j in self._waiting if j is job) < limit:
+                log.msg("execution of %s queued" % repr(job))
+                self._waiting.append(job)
+                return False
+        elif action['action'] == self.RescheduleBlocked:
+            args = action['args']
+            delay = _toSeconds(args[0]) if len(args) > 0 else 1
+            maxDelay = _toSeconds(args[1]) if len(args) > 1 else 60
+            factor = args[2] if len(args) > 2 else 2
+            delay = min(delay * factor ** job.blockedRetries, maxDelay)
+            job.blockedRetries += 1
+            log.msg("execution of %s rescheduled in %.3fs" % (repr(job), delay))
+            job.timeHandler = self.callLater(delay, self._startJob, job)
+            return False
+        self._skipBlocked(job)
+        return False
+
+    def jobFinished(self, job):
+        """Signal from job. Releases its resources and starts queued jobs"""
+        for name in self._heldResources.pop(job.id, ()):
+            self.resourceUsage[name] -= 1
+        if self._waiting and not (self._waitingTimer and self._waitingTimer.active()):
+            self._waitingTimer = self.callLater(0, self._startWaiting)
+
+    def _findBlocker(self, job):
+        """@return: working job or exhausted resource name blocking given job or None"""
+        for j in self.blockers.get(job.id, ()):
             if j.isWorking():
-                if jid not in self.blockActions:
-                    from rcore import Core
-
-                    Core.instance().getRPCService("alarm").notify("Execution of %s was blocked by currently"
-                                                            " working %s and no handlers for this case were set. This"
-                                                            " usually means architectural design flaw." % \
-                                                            (repr(job), repr(j)), ["error"])
-                    return False
-                if self.blockActions[jid]['action'] == self.QueueBlocked:
-                    log.msg("execution of %s queued" % repr(job))
-
-                    def queueExecution(result, job):
-                        log.msg("executing queued job" % repr(job))
-                        reactor.callLater(0, job._execute)
-                        return result
-
-                    j.currentDeferred.addBoth(queueExecution, job)
-                if self.blockActions[jid]['action'] == self.RescheduleBlocked:
-                    raise Exception("RescheduleBlocked is not implemented")
+                return j
+        for name in job.resources:
+            if name in self.resourceLimits and self.resourceUsage[name] >= self.resourceLimits[name]:
+                return name
+        return None
 
-                return False
-        return True
+    def _acquire(self, job):
+        held = [name for name in job.resources if name in self.resourceLimits]
+        for name in held:
+            self.resourceUsage[name] += 1
+        if held:
+            self._heldResources[job.id] = held
+
+    def _skipBlocked(self, job):
+        log.msg("execution of %s skipped" % repr(job))
+        job._stats.count("skipped")
+        if job.timeHandler and job.timeHandler.active(): # forced run, regular one is still planned
+            return
+        if job.isRepeated():
+            job._nextLoop()
+        else:
+            self.removeJob(job)
+
+    def _startWaiting(self):
+        self._waitingTimer = None
+        waiting, self._waiting = self._waiting, collections.deque()
+        for job in waiting:
+            if job.id not in self.jobs or job.state == STATE_PAUSED:
+                continue
+            if job.state == STATE_WORK or self._findBlocker(job) is not None:
+                self._waiting.append(job)
+                continue
+            self._startJob(job)
 
 
 scheduler = Scheduler()
@@ -0,0 +1,322 @@
+# Copyright (c) 2013, Il'inykh Sergey
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#    * Redistributions of source code must retain the above copyright
+#      notice, this list of conditions and the following disclaimer.
+#    * Redistributions in binary form must reproduce the above copyright
+#      notice, this list of conditions and the following disclaimer in the
+#      documentation and/or other materials provided with the distribution.
+#    * Neither the name of the <organization> nor the
+#      names of its contributors may be used to endorse or promote products
+#      derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL IL'INYKH SERGEY BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+# Low overhead runtime statistics
+#
+# Histogram keeps counts in fixed exponential buckets, Meter keeps exponentially decaying rate.
+# Objects providing stats() method may be registered by name to be collected together
+# (for example by XML-RPC introspection, see rcore.xmlrpc.addStatistics).
+#
+# usage:
+# from rcore import stats
+# stats.register("queue", "provisioning", myQueue)
+# stats.collect("queue")  # {"provisioning": myQueue.stats()}
+
+from __future__ import absolute_import
+
+import bisect
+import math
+import time
+import weakref
+
+# seconds. values above the last bound go to overflow bucket
+DEFAULT_BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                  1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+SIZE_BOUNDS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+class Histogram(object):
+    def __init__(self, bounds=DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Returns upper bound of the bucket containing p-th percentile (max value for overflow bucket)
+        """
+        if not self.count:
+            return None
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def toDict(self):
+        return dict(
+            count=self.count,
+            sum=self.sum,
+            min=self.min or 0,
+            max=self.max or 0,
+            avg=self.sum / self.count if self.count else 0,
+            p50=self.percentile(50) or 0,
+            p90=self.percentile(90) or 0,
+            p99=self.percentile(99) or 0,
+            buckets=[[b, c] for b, c in zip(list(self.bounds) + ["inf"], self.counts) if c]
+        )
+
+
+class Meter(object):
+    """
+    Counts events and keeps their rate per second averaged over last `period` seconds
+    """
+    def __init__(self, period=60.0):
+        self.period = float(period)
+        self.count = 0
+        self._rate = 0.0
+        self._updated = time.time()
+
+    def _decay(self, now):
+        dt = now - self._updated
+        if dt > 0:
+            self._rate *= math.exp(-dt / self.period)
+            self._updated = now
+
+    def mark(self, n=1, now=None):
+        self._decay(now or time.time())
+        self.count += n
+        self._rate += n / self.period
+
+    def rate(self):
+        self._decay(time.time())
+        return self._rate
+
+
+class QueueStats(object):
+    """
+    Statistics of DQueue / ActionQueue
+    """
+    def __init__(self):
+        self.waitTime = Histogram()
+        self.execTime = Histogram()
+        self.throughput = Meter()
+        self.enqueued = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.running = 0
+        self.peakRunning = 0
+        self.peakDepth = 0
+
+    def started(self, waited=None):
+        if waited is not None:
+            self.waitTime.add(waited)
+        self.running += 1
+        if self.running > self.peakRunning:
+            self.peakRunning = self.running
+
+    def finished(self, duration, failed=False):
+        self.running -= 1
+        self.execTime.add(duration)
+        self.throughput.mark()
+        if failed:
+            self.failed += 1
+
+    def toDict(self, depth=0):
+        if depth > self.peakDepth:
+            self.peakDepth = depth
+        return dict(
+            depth=depth,
+            peakDepth=self.peakDepth,
+            running=self.running,
+            peakRunning=self.peakRunning,
+            enqueued=self.enqueued,
+            finished=self.throughput.count,
+            failed=self.failed,
+            rejected=self.rejected,
+            dropped=self.dropped,
+            coalesced=self.coalesced,
+            throughput=self.throughput.rate(),
+            waitTime=self.waitTime.toDict(),
+            execTime=self.execTime.toDict()
+        )
+
+
+class JobStats(object):
+    """
+    Statistics of scheduler jobs. Every event is also counted by parent if any,
+    so scheduler keeps totals of all its jobs.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.lag = Histogram()
+        self.duration = Histogram()
+        self.running = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timedOut = 0
+        self.blocked = 0
+        self.skipped = 0
+        self.missed = 0
+        self.delegated = 0
+
+    def started(self, lag=None):
+        if lag is not None:
+            self.lag.add(max(lag, 0))
+        self.running += 1
+        if self.parent:
+            self.parent.started(lag)
+
+    def finished(self, duration, failed=False):
+        self.running -= 1
+        self.duration.add(duration)
+        if failed:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+        if self.parent:
+            self.parent.finished(duration, failed)
+
+    def count(self, event, n=1):
+        """
+        @param event: "timedOut", "blocked", "skipped", "missed" or "delegated"
+        """
+        if not n:
+            return
+        setattr(self, event, getattr(self, event) + n)
+        if self.parent:
+            self.parent.count(event, n)
+
+    def toDict(self):
+        return dict(
+            runs=self.succeeded + self.failed,
+            running=self.running,
+            succeeded=self.succeeded,
+            failed=self.failed,
+            timedOut=self.timedOut,
+            blocked=self.blocked,
+            skipped=self.skipped,
+            missed=self.missed,
+            delegated=self.delegated,
+            lag=self.lag.toDict(),
+            duration=self.duration.toDict()
+        )
+
+
+class RPCStats(object):
+    """
+    Statistics of XML-RPC procedure. Every event is also counted by parent if any,
+    so server keeps totals of all procedures.
+    """
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.calls = Meter()
+        self.running = 0
+        self.faults = {} # fault code -> count
+        self.execTime = Histogram()
+        self.parseTime = Histogram()
+        self.marshalTime = Histogram()
+        self.totalTime = Histogram()
+        self.requestSize = Histogram(SIZE_BOUNDS)
+        self.responseSize = Histogram(SIZE_BOUNDS)
+
+    def started(self):
+        self.running += 1
+        if self.parent:
+            self.parent.started()
+
+    def finished(self, duration, faultCode=None):
+        self.running -= 1
+        self.calls.mark()
+        self.execTime.add(duration)
+        if faultCode is not None:
+            self.fault(faultCode)
+        if self.parent:
+            self.parent.finished(duration)
+
+    def fault(self, faultCode):
+        self.faults[faultCode] = self.faults.get(faultCode, 0) + 1
+        if self.parent:
+            self.parent.fault(faultCode)
+
+    def transferred(self, requestSize, responseSize, parseTime, marshalTime, totalTime):
+        """
+        Counts HTTP request of the procedure (system.multicall request for its calls)
+        """
+        self.requestSize.add(requestSize)
+        self.responseSize.add(responseSize)
+        self.parseTime.add(parseTime)
+        self.marshalTime.add(marshalTime)
+        self.totalTime.add(totalTime)
+        if self.parent:
+            self.parent.transferred(requestSize, responseSize, parseTime, marshalTime, totalTime)
+
+    def toDict(self):
+        return dict(
+            calls=self.calls.count,
+            rate=self.calls.rate(),
+            running=self.running,
+            faults=dict((str(code), n) for code, n in self.faults.items()),
+            requests=self.totalTime.count,
+            execTime=self.execTime.toDict(),
+            parseTime=self.parseTime.toDict(),
+            marshalTime=self.marshalTime.toDict(),
+            totalTime=self.totalTime.toDict(),
+            requestSize=self.requestSize.toDict(),
+            responseSize=self.responseSize.toDict()
+        )
+
+
+_registry = {}
+
+
+def register(category, name, obj):
+    """
+    Registers object with stats() method to be collected by category.
+
+    Only weak reference to obj is kept
+    """
+    _registry.setdefault(category, weakref.WeakValueDictionary())[name] = obj
+
+
+def unregister(category, name):
+    _registry.get(category, {}).pop(name, None)
+
+
+def collect(category):
+    """
+    @return: dict name -> obj.stats() for all alive objects registered in the category
+    """
+    return dict((name, obj.stats()) for name, obj in _registry.get(category, {}).items())
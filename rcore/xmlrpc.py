@@ -25,18 +25,28 @@
 
 from __future__ import absolute_import
 
+import base64
+import time
 import xmlrpclib
 import urlparse
+from StringIO import StringIO
 
 from xml.sax.saxutils import escape
 from twisted.web import server, xmlrpc, http, resource
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody, BrowserLikePolicyForHTTPS
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
 from twisted.python import failure, log
-from twisted.internet import reactor, defer
-from twisted.internet.error import ConnectionRefusedError
+from twisted.internet import reactor, defer, protocol
+from twisted.internet.error import ConnectError, TimeoutError
+from zope.interface import implementer
 
-from rcore import config, user, Core
-from rcore.error import getFailureFor, RegularError, InternalError, NoRPCProxiesLeft
+from rcore import config, user, Core, stats
+from rcore.error import getFailureFor, RegularError, InternalError, NoRPCProxiesLeft, InvalidParametersError
+from rcore.queue import DQueue
 from rcore.rpctools import RPCService
+from rcore.scheduler import scheduler
+from rcore.debug import debug
 from rcore.context import Context, waitForDeferred, makeContext, setCurrentContext, deleteContext
 from twisted.web.xmlrpc import Fault
 
@@ -72,6 +82,7 @@ class Site(server.Site):
     def __init__(self, *args, **kwargs):
         server.Site.__init__(self, *args, **kwargs)
         self._activeState = True
+        self.admission = None
 
     def startFactory(self):
         server.Site.startFactory(self)
@@ -80,6 +91,21 @@ class Site(server.Site):
     def setActiveState(self, state, comment = ""):
         self._activeState = state
         self._activeStateComment = comment
+
+    def setAdmissionControl(self, admission=True, name="default"):
+        """
+        Enables load shedding of XML-RPC requests
+
+        @param admission: AdmissionControl, True to make one configured by config, None to disable
+        @param name: name of admission statistics (see stats.admission procedure)
+        """
+        if admission is True:
+            admission = AdmissionControl()
+        self.admission = admission
+        if admission is None:
+            stats.unregister("admission", name)
+        else:
+            stats.register("admission", name, admission)
         
     def render(self, resrc):
         if self._activeState:
@@ -98,6 +124,172 @@ class Site(server.Site):
         self.finish()
 
 
+class _Overloaded(Exception):
+    pass
+
+
+class AdmissionControl(object):
+    """
+    Limits requests executed by XMLRPC resources of a Site (see Site.setAdmissionControl).
+
+    Request over global (maxInFlight) or per method (setMethodLimit) limit waits in a queue of maxQueued
+    requests for up to queueTimeout seconds. Request not admitted in time or not fitting the queue is
+    answered by 503 with Retry-After header without executing procedures. When both global limit and
+    the queue are full request is rejected before its body is parsed, otherwise it's parsed first
+    to learn method name.
+    With fairShare on, one login may hold no more than its share of maxInFlight among logins
+    having requests in flight or waiting, so one busy client can't starve the others.
+    system.multicall is admitted as one request.
+
+    Limits come from config's xmlrpc.admission section when present (max_in_flight, max_queued,
+    queue_timeout, retry_after, fair_share, methods: {name: limit}) and follow its changes.
+    None limit means unlimited.
+    """
+    maxInFlight = None
+    maxQueued = 100
+    queueTimeout = 5.0
+    retryAfter = 1
+    fairShare = False
+
+    def __init__(self, maxInFlight=None, maxQueued=None, queueTimeout=None, retryAfter=None, fairShare=None):
+        self._defaults = dict(max_in_flight=maxInFlight, max_queued=maxQueued, queue_timeout=queueTimeout,
+            retry_after=retryAfter, fair_share=fairShare)
+        self.methodLimits = {}
+        self.inFlight = 0
+        self._methods = {} # method -> requests in flight
+        self._users = {} # login -> requests in flight
+        self._waiting = [] # [method, login, Deferred, timeout call]
+        self._draining = False
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.update()
+        config.connect("changed", self.configChanged)
+
+    def configChanged(self, sender):
+        self.update()
+        self._drain()
+
+    def update(self):
+        try:
+            conf = config()['xmlrpc']['admission']
+        except Exception:
+            conf = {}
+        def get(name, attr):
+            if name in conf:
+                return conf[name]
+            if self._defaults[name] is not None:
+                return self._defaults[name]
+            return getattr(type(self), attr)
+        self.maxInFlight = get("max_in_flight", "maxInFlight")
+        self.maxQueued = int(get("max_queued", "maxQueued"))
+        self.queueTimeout = float(get("queue_timeout", "queueTimeout"))
+        self.retryAfter = int(get("retry_after", "retryAfter"))
+        self.fairShare = bool(get("fair_share", "fairShare"))
+        if "methods" in conf:
+            self.methodLimits = dict(conf["methods"])
+
+    def setMethodLimit(self, method, limit):
+        """
+        @param limit: max requests of method executed at once, None removes the limit
+        """
+        if limit is None:
+            self.methodLimits.pop(method, None)
+        else:
+            self.methodLimits[method] = int(limit)
+        self._drain()
+        return self
+
+    def admit(self, method, login):
+        """
+        @return: Deferred fired when request may execute or failed by _Overloaded.
+            Admitted request must be released by release(method, login)
+        """
+        if not self._waiting and self._mayStart(method, login):
+            self._start(method, login)
+            return defer.succeed(None)
+        if len(self._waiting) >= self.maxQueued:
+            self.rejected += 1
+            return defer.fail(_Overloaded())
+        entry = [method, login, defer.Deferred(), None]
+        entry[3] = reactor.callLater(self.queueTimeout, self._expire, entry)
+        self._waiting.append(entry)
+        self._drain()
+        return entry[2]
+
+    def release(self, method, login):
+        self.inFlight -= 1
+        for counts, key in ((self._methods, method), (self._users, login)):
+            counts[key] -= 1
+            if not counts[key]:
+                del counts[key]
+        self._drain()
+
+    def saturated(self):
+        """
+        @return: True if global limit and the queue are full, so any request would be rejected
+        """
+        return (self.maxInFlight is not None and self.inFlight >= self.maxInFlight
+            and len(self._waiting) >= self.maxQueued)
+
+    def stats(self):
+        return dict(inFlight=self.inFlight, waiting=len(self._waiting), methods=dict(self._methods),
+            admitted=self.admitted, rejected=self.rejected, expired=self.expired)
+
+    def _mayStart(self, method, login):
+        if self.maxInFlight is not None and self.inFlight >= self.maxInFlight:
+            return False
+        limit = self.methodLimits.get(method)
+        if limit is not None and self._methods.get(method, 0) >= limit:
+            return False
+        if self.fairShare and self.maxInFlight is not None:
+            logins = set(self._users)
+            logins.update(entry[1] for entry in self._waiting)
+            logins.add(login)
+            if self._users.get(login, 0) >= max(1, self.maxInFlight // len(logins)):
+                return False
+        return True
+
+    def _start(self, method, login):
+        self.inFlight += 1
+        self._methods[method] = self._methods.get(method, 0) + 1
+        self._users[login] = self._users.get(login, 0) + 1
+        self.admitted += 1
+
+    def _drain(self):
+        # admitted request may finish synchronously and release its slot from the callback.
+        # nested call leaves the work to the running loop which re-checks the queue after every start
+        if self._draining:
+            return
+        self._draining = True
+        try:
+            while True:
+                entry = self._nextStartable()
+                if entry is None:
+                    break
+                self._waiting.remove(entry)
+                entry[3].cancel()
+                self._start(entry[0], entry[1])
+                entry[2].callback(None)
+        finally:
+            self._draining = False
+
+    def _nextStartable(self):
+        # requests blocked by method or login limits don't hold the ones behind them
+        for entry in self._waiting:
+            if self.maxInFlight is not None and self.inFlight >= self.maxInFlight:
+                return None
+            if self._mayStart(entry[0], entry[1]):
+                return entry
+        return None
+
+    def _expire(self, entry):
+        self._waiting.remove(entry)
+        self.expired += 1
+        entry[2].errback(_Overloaded())
+        self._drain() # fair shares grow when login leaves the queue
+
+
 class XMLRPC(xmlrpc.XMLRPC):
     """
     RCore XML-RPC Resource
@@ -105,9 +297,13 @@ class XMLRPC(xmlrpc.XMLRPC):
     Difference from twisted xml-rpc:
     1) support for authentication
     2) support for context per request
+    3) support for system.multicall executing calls concurrently
+    4) per procedure statistics (see stats.rpc procedure) and log of requests slower than slowRequestTime
     """
 
     enable_guest = False
+    multicallConcurrency = 8
+    slowRequestTime = 1.0 # seconds, None disables the log
 
     def auth(self, user, passwd):
         global _defaultUser
@@ -123,47 +319,227 @@ class XMLRPC(xmlrpc.XMLRPC):
             request.setResponseCode(http.UNAUTHORIZED)
             return (user=='' and passwd=='') and 'Authorization required!' or 'Authorization failed!'
 
+        started = time.time()
+        admission = getattr(request.site, "admission", None)
+        if admission is not None and admission.saturated():
+            admission.rejected += 1
+            self._shed(request, admission)
+            return server.NOT_DONE_YET
         request.content.seek(0, 0)
         request.setHeader("content-type", "text/xml")
+        body = request.content.read()
         try:
-            args, functionPath = xmlrpclib.loads(request.content.read(), use_datetime=True)
+            args, functionPath = xmlrpclib.loads(body, use_datetime=True)
         except Exception as e:
             f = xmlrpclib.Fault(self.FAILURE, "Can't deserialize input: %s" % (e,))
-            self._cbRender(f, request)
+            _rpcTotals.fault(self.FAILURE)
+            self._render(f, request, None, None, (started, time.time() - started, len(body)))
         else:
-            try:
-                function = self.lookupProcedure(functionPath)
-            except xmlrpclib.Fault as f:
-                self._cbRender(f, request)
+            timing = (started, time.time() - started, len(body))
+            # Use this list to track whether the response has failed or not.
+            # This will be used later on to decide if the result of the
+            # Deferred should be written out and Request.finish called.
+            responseFailed = []
+            request.notifyFinish().addErrback(responseFailed.append)
+            if admission is None:
+                self._dispatch(request, functionPath, args, responseFailed, timing)
             else:
-                def closeReq(result):
-                    deleteContext(requestId)
-                    if isinstance(result, failure.Failure) and not isinstance(result.value, xmlrpclib.Fault):
-                        if isinstance(result.value, RegularError):
-                            log.msg("Request error: " + repr(result.value))
-                            return xmlrpclib.Fault(result.value.code, str(result.value))
-                        log.msg("Request finished with unexpected error. see traceback below")
-                        result.printTraceback()
-                        return xmlrpclib.Fault("INTERNAL_ERROR", str(result.value))
-                    
-                    return result
-                
-                requestId = makeContext(Request, request, (functionPath, args))
-                setCurrentContext(requestId)
-                # Use this list to track whether the response has failed or not.
-                # This will be used later on to decide if the result of the
-                # Deferred should be written out and Request.finish called.
-                responseFailed = []
-                request.notifyFinish().addErrback(responseFailed.append)
-                if getattr(function, 'withRequest', False):
-                    d = defer.maybeDeferred(function, request, *args)
-                else:
-                    d = defer.maybeDeferred(function, *args)
-                d.addBoth(closeReq)
-                d.addErrback(self._ebRender)
-                d.addCallback(self._cbRender, request, responseFailed)
+                d = admission.admit(functionPath, user)
+                d.addCallbacks(self._admitted, self._rejected,
+                    (request, functionPath, args, responseFailed, timing, admission), None,
+                    (request, responseFailed, admission))
         return server.NOT_DONE_YET
 
+    def _dispatch(self, request, functionPath, args, responseFailed, timing):
+        # unexpected errors are answered as faults, so admission slot is released as well
+        if functionPath == "system.multicall":
+            d = defer.maybeDeferred(self._multicall, request, args)
+        else:
+            d = defer.maybeDeferred(self._callProcedure, request, functionPath, args)
+        d.addErrback(self._ebRender)
+        d.addCallback(self._render, request, responseFailed, functionPath, timing)
+        return d
+
+    def _render(self, result, request, responseFailed, functionPath, timing):
+        """
+        Writes result out and counts request's timing and sizes
+
+        @param timing: (time request handling started, parse time, request size)
+        """
+        started, parseTime, requestSize = timing
+        marshalStarted = time.time()
+        self._cbRender(result, request, responseFailed)
+        now = time.time()
+        if functionPath == "system.multicall":
+            target = _methodStats(functionPath)
+        else:
+            target = _rpcMethods.get(functionPath, _rpcTotals) # unknown procedures are counted in totals only
+        target.transferred(requestSize, request.sentLength, parseTime, now - marshalStarted, now - started)
+        threshold = self._slowRequestTime()
+        if threshold is not None and now - started >= threshold:
+            log.msg("Slow XML-RPC %s from %s: %.3fs (parse %.3fs, marshal %.3fs), %d bytes in, %d bytes out" % (
+                functionPath, request.getUser(), now - started, parseTime, now - marshalStarted,
+                requestSize, request.sentLength))
+
+    def _admitted(self, _, request, functionPath, args, responseFailed, timing, admission):
+        login = request.getUser()
+        if responseFailed:
+            # client has gone while request was waiting
+            admission.release(functionPath, login)
+            return
+        d = self._dispatch(request, functionPath, args, responseFailed, timing)
+        d.addBoth(lambda result: admission.release(functionPath, login))
+
+    def _rejected(self, f, request, responseFailed, admission):
+        f.trap(_Overloaded)
+        if not responseFailed:
+            self._shed(request, admission)
+
+    def _shed(self, request, admission):
+        request.setResponseCode(http.SERVICE_UNAVAILABLE)
+        request.setHeader("content-type", "text/plain")
+        request.setHeader("retry-after", str(admission.retryAfter))
+        request.write("Server is overloaded, retry later")
+        request.finish()
+
+
+    def _callProcedure(self, request, functionPath, args):
+        """
+        Executes procedure in its own Request context
+
+        @return: Deferred fired with procedure's result or xmlrpclib.Fault
+        """
+        try:
+            function = self.lookupProcedure(functionPath)
+        except xmlrpclib.Fault as f:
+            _rpcTotals.fault(f.faultCode)
+            return defer.succeed(f)
+
+        def closeReq(result):
+            deleteContext(requestId)
+            if isinstance(result, failure.Failure) and not isinstance(result.value, xmlrpclib.Fault):
+                if isinstance(result.value, RegularError):
+                    log.msg("Request error: " + repr(result.value))
+                    return xmlrpclib.Fault(result.value.code, str(result.value))
+                log.msg("Request finished with unexpected error. see traceback below")
+                result.printTraceback()
+                return xmlrpclib.Fault("INTERNAL_ERROR", str(result.value))
+
+            return result
+
+        def count(result):
+            methodStats.finished(time.time() - started,
+                result.faultCode if isinstance(result, xmlrpclib.Fault) else None)
+            return result
+
+        requestId = makeContext(Request, request, (functionPath, args))
+        setCurrentContext(requestId)
+        methodStats = _methodStats(functionPath)
+        methodStats.started()
+        started = time.time()
+        if getattr(function, 'withRequest', False):
+            d = defer.maybeDeferred(function, request, *args)
+        else:
+            d = defer.maybeDeferred(function, *args)
+        d.addBoth(closeReq)
+        d.addCallback(count)
+        return d
+
+    def _multicall(self, request, args):
+        """
+        Executes system.multicall calls concurrently (see multicallConcurrency)
+
+        @return: Deferred fired with list of [result] or fault structs in calls order
+        """
+        if len(args) != 1 or not isinstance(args[0], (list, tuple)):
+            return defer.succeed(xmlrpclib.Fault(self.FAILURE, "system.multicall expects list of calls"))
+
+        def call(spec):
+            if not isinstance(spec, dict) or "methodName" not in spec:
+                return xmlrpclib.Fault(self.FAILURE, "Invalid system.multicall call: %r" % (spec,))
+            if spec["methodName"] == "system.multicall":
+                return xmlrpclib.Fault(self.FAILURE, "Recursive system.multicall is forbidden")
+            return self._callProcedure(request, spec["methodName"], tuple(spec.get("params", ())))
+
+        def toMulticall(results):
+            ret = []
+            for success, result, spec in results:
+                if not success: # can't happen since _callProcedure converts errors to faults
+                    result = xmlrpclib.Fault("INTERNAL_ERROR", str(result.value))
+                if isinstance(result, xmlrpclib.Fault):
+                    ret.append({"faultCode": result.faultCode, "faultString": result.faultString})
+                else:
+                    ret.append([result])
+            return ret
+
+        q = DQueue(args[0], call)
+        q.setConcurrency(self._multicallConcurrency())
+        return q.run().addCallback(toMulticall)
+
+    def _multicallConcurrency(self):
+        """Max calls of system.multicall executed at the same time. config's xmlrpc.multicall_concurrency if set"""
+        try:
+            concurrency = int(config()['xmlrpc']['multicall_concurrency'])
+        except Exception:
+            concurrency = self.multicallConcurrency
+        return max(1, concurrency)
+
+    def _slowRequestTime(self):
+        """Requests taking longer are logged. config's xmlrpc.slow_request_time if set"""
+        try:
+            return config()['xmlrpc']['slow_request_time']
+        except Exception:
+            return self.slowRequestTime
+
+
+_rpcTotals = stats.RPCStats()
+_rpcMethods = {} # procedure name -> stats.RPCStats
+
+
+def _methodStats(functionPath):
+    if functionPath not in _rpcMethods:
+        _rpcMethods[functionPath] = stats.RPCStats(_rpcTotals)
+    return _rpcMethods[functionPath]
+
+
+class Statistics(xmlrpc.XMLRPC):
+    """
+    Introspection of daemon's runtime statistics. Use addStatistics to enable it.
+    """
+
+    def xmlrpc_queues(self):
+        """Returns statistics of named DQueue and ActionQueue instances"""
+        return stats.collect("queue")
+
+    def xmlrpc_scheduler(self):
+        """Returns statistics of scheduler and its jobs"""
+        return scheduler.stats()
+
+    def xmlrpc_rpc(self, functionPath=None):
+        """
+        Returns statistics of XML-RPC procedures: calls, faults by code, parse, execution, marshal
+        and total time, request and response sizes. Totals of all procedures are under "total" key
+
+        @param functionPath: name of procedure to return statistics of only
+        """
+        if functionPath is not None:
+            if functionPath not in _rpcMethods:
+                raise InvalidParametersError("No statistics of %s" % functionPath)
+            return _rpcMethods[functionPath].toDict()
+        return dict(total=_rpcTotals.toDict(),
+            methods=dict((name, s.toDict()) for name, s in _rpcMethods.items()))
+
+    def xmlrpc_admission(self):
+        """Returns admission control statistics of sites"""
+        return stats.collect("admission")
+
+
+def addStatistics(resource):
+    """
+    Adds statistics procedures like stats.queues and stats.scheduler to XML-RPC resource
+    """
+    resource.putSubHandler("stats", Statistics())
+
 
 class Request(Context):
 
@@ -173,6 +549,118 @@ class Request(Context):
         log.msg("XML-RPC from %s: " % self.initiator + callParams[0] + str(callParams[1]))
         
 
+class PooledProxy(object):
+    """
+    XML-RPC proxy sending calls over shared HTTP/1.1 keep-alive connections.
+    Interface is compatible with twisted.web.xmlrpc.Proxy. Use getProxy to get one.
+    """
+
+    def __init__(self, url, agent, limiter, allowNone=False, useDateTime=False):
+        data = urlparse.urlparse(url)
+        self.url = urlparse.urlunparse((data.scheme, data.hostname + (":%d" % data.port if data.port else ""),
+                                        data.path or "/", data.params, data.query, ""))
+        self.headers = {"Content-Type": ["text/xml"], "User-Agent": ["rcore XML-RPC"]}
+        if data.username:
+            auth = base64.b64encode("%s:%s" % (urlparse.unquote(data.username), urlparse.unquote(data.password or "")))
+            self.headers["Authorization"] = ["Basic " + auth]
+        self.agent = agent
+        self.limiter = limiter
+        self.allowNone = allowNone
+        self.useDateTime = useDateTime
+
+    def callRemote(self, method, *args):
+        body = xmlrpclib.dumps(args, method, allow_none=self.allowNone)
+        return self.limiter.run(self._send, body)
+
+    def _send(self, body):
+        d = self.agent.request("POST", self.url, Headers(self.headers), FileBodyProducer(StringIO(body)))
+        d.addCallback(self._cbResponse)
+        return d
+
+    def _cbResponse(self, response):
+        if response.code != 200:
+            response.deliverBody(_Discard())
+            raise ValueError(str(response.code), response.phrase) # the same as twisted's Proxy
+        return readBody(response).addCallback(self._parse)
+
+    def _parse(self, body):
+        return xmlrpclib.loads(body, use_datetime=self.useDateTime)[0][0] # raises Fault if any
+
+
+class _Discard(protocol.Protocol):
+    """Reads and drops response body, so connection may be reused"""
+    def connectionLost(self, reason):
+        pass
+
+
+_pool = None
+_agent = None
+_limiters = {} # (scheme, host, port) -> DeferredSemaphore
+_proxies = {}
+
+
+def _poolSettings():
+    """
+    Settings of outgoing connection pool from config's xmlrpc.pool section
+    """
+    ret = dict(max_per_host=10, max_idle_per_host=4, idle_timeout=30, connect_timeout=30, verify_tls=False)
+    try:
+        ret.update(config()['xmlrpc']['pool'])
+    except Exception:
+        pass
+    return ret
+
+
+@implementer(IPolicyForHTTPS)
+class _NoVerifyPolicy(object):
+    """TLS without certificate verification like twisted.web.xmlrpc.Proxy does"""
+
+    def creatorForNetloc(self, hostname, port):
+        from twisted.internet.ssl import CertificateOptions
+        return CertificateOptions(verify=False)
+
+
+def _configurePool(sender=None):
+    settings = _poolSettings()
+    _pool.maxPersistentPerHost = int(settings["max_idle_per_host"])
+    _pool.cachedConnectionTimeout = float(settings["idle_timeout"])
+
+
+def getProxy(url, allowNone=False, useDateTime=False):
+    """
+    Returns shared XML-RPC proxy of url. All proxies use one HTTP/1.1 keep-alive connection pool.
+
+    Pool is configured by config's xmlrpc.pool section: max_per_host - max simultaneous connections to a host,
+    max_idle_per_host - max idle connections kept for a host, idle_timeout - seconds idle connection is kept,
+    connect_timeout - seconds. Keep idle_timeout lower than servers' keep-alive timeout.
+    Certificates of https servers are not verified (self-signed ones are fine) unless verify_tls is true.
+    connect_timeout and verify_tls are applied on first call only.
+
+    @param url: "http(s)://[user:password@]host[:port]/path"
+    @rtype: PooledProxy
+    """
+    global _pool, _agent
+    if isinstance(url, unicode):
+        url = url.encode("utf-8")
+    key = (url, allowNone, useDateTime)
+    if key not in _proxies:
+        if _pool is None:
+            _pool = HTTPConnectionPool(reactor, persistent=True)
+            _pool.retryAutomatically = False # XML-RPC calls are not idempotent
+            _configurePool()
+            config.connect("changed", _configurePool)
+            reactor.addSystemEventTrigger("before", "shutdown", _pool.closeCachedConnections)
+            settings = _poolSettings()
+            policy = BrowserLikePolicyForHTTPS() if settings["verify_tls"] else _NoVerifyPolicy()
+            _agent = Agent(reactor, policy, connectTimeout=float(settings["connect_timeout"]), pool=_pool)
+        data = urlparse.urlparse(url)
+        host = (data.scheme, data.hostname, data.port)
+        if host not in _limiters:
+            _limiters[host] = defer.DeferredSemaphore(int(_poolSettings()["max_per_host"]))
+        _proxies[key] = PooledProxy(url, _agent, _limiters[host], allowNone, useDateTime)
+    return _proxies[key]
+
+
 class Service(RPCService):
     _namespaceSeparator = "."
     _alertable = False
@@ -187,70 +675,204 @@ class Service(RPCService):
         mpath = self._methodPath and self._namespaceSeparator.join([self._methodPath, name]) or name
         return self.__class__(mpath)
     
-    @defer.deferredGenerator
     def __call__(self, *params):
-        if self._methodPath:
-            try:
-                print ("XML-RPC %s:" % self.__class__.__name__, self._methodPath, params)
-                proxy = self._getProxy()
+        if not self._methodPath:
+            return defer.fail(InternalError("method name is not given"))
+        return self._callRemote(self._getProxy, params)
+
+    @defer.deferredGenerator
+    def _callRemote(self, getProxy, params, timeout=None):
+        """
+        Calls the method with proxy returned by getProxy
+
+        @param timeout: seconds call may last. it's cancelled and fails with TimeoutError after that
+        """
+        try:
+            if debug.enabled:
+                debug.trace("XML-RPC %s: %s%s" % (self.__class__.__name__, self._methodPath, params))
+            proxy = getProxy()
+            if hasattr(proxy, "queryFactory"): # twisted's Proxy
                 proxy.queryFactory.noisy = False
-                wfd = waitForDeferred(proxy.callRemote(self._methodPath, *params))
-                wfd.setRestoreContext(self.restoreContext)
-                yield wfd
-                result = wfd.getResult()
-                yield result
-                return
-            except Exception as e:
-                errStr = str(e) if isinstance(e, Fault) else getFailureFor(e).getTraceback()
-                msg = "Internal XML-RPC Failed: " + self.__class__.__name__ + ":" + self._methodPath + \
-                    str(params) + "\n" + errStr
-                log.msg(msg)
-                self.__class__._lastError = msg
-                if self._alertable:
-                    Core.instance().getRPCService("alarm").notify([msg,
-                        "<div style='color:#ff0000;font-weight:bold'>%s</div>" % escape(self.__class__._lastError).replace("\n", "<br/>")], ["error"])
-                raise
-        else:
-            raise InternalError("method name is not given")
+            d = proxy.callRemote(self._methodPath, *params)
+            if timeout:
+                d = _withTimeout(d, timeout)
+            wfd = waitForDeferred(d)
+            wfd.setRestoreContext(self.restoreContext)
+            yield wfd
+            result = wfd.getResult()
+            yield result
+            return
+        except Exception as e:
+            errStr = str(e) if isinstance(e, Fault) else getFailureFor(e).getTraceback()
+            msg = "Internal XML-RPC Failed: " + self.__class__.__name__ + ":" + self._methodPath + \
+                str(params) + "\n" + errStr
+            log.msg(msg)
+            self.__class__._lastError = msg
+            if self._alertable:
+                Core.instance().getRPCService("alarm").notify([msg,
+                    "<div style='color:#ff0000;font-weight:bold'>%s</div>" % escape(self.__class__._lastError).replace("\n", "<br/>")], ["error"])
+            raise
             
     def _getProxy(self):
         raise NotImplementedError("_getProxy must be implemented in an inherited class")
         
         
+def _withTimeout(d, timeout):
+    """Cancels d after timeout seconds. Cancelled d fails with TimeoutError"""
+    timedOut = []
+
+    def cancel():
+        timedOut.append(True)
+        d.cancel()
+
+    def finished(result):
+        if dc.active():
+            dc.cancel()
+        if timedOut and isinstance(result, failure.Failure): # cancellation may be wrapped, e.g. by web client
+            raise TimeoutError("call lasted more than %s seconds" % timeout)
+        return result
+
+    dc = reactor.callLater(timeout, cancel)
+    return d.addBoth(finished)
+
+
+BALANCE_ROUND_ROBIN = "round-robin"
+BALANCE_LEAST_OUTSTANDING = "least-outstanding"
+BALANCE_EWMA = "ewma" # least latency (exponentially weighted) multiplied by outstanding calls
+
+EWMA_WEIGHT = 0.3 # weight of the last call latency
+
+
+class _Endpoint(object):
+    """
+    Load and health of one proxy of ExchangableService. Works as circuit breaker:
+    closed - calls pass, open - endpoint is skipped, half-open - one probe call decides to close or open it again
+    """
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, proxy):
+        self.proxy = proxy
+        self.outstanding = 0
+        self.latency = None
+        self.failures = 0 # consecutive
+        self.state = self.CLOSED
+        self.openedAt = None
+        self.probing = False
+
+    def available(self, now, openTimeout):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN:
+            return now - self.openedAt >= openTimeout
+        return not self.probing
+
+    def load(self, balancing):
+        if balancing == BALANCE_LEAST_OUTSTANDING:
+            return self.outstanding
+        if balancing == BALANCE_EWMA:
+            return (self.latency or 0) * (self.outstanding + 1)
+        return 0
+
+    def started(self):
+        self.outstanding += 1
+        if self.state != self.CLOSED:
+            self.state = self.HALF_OPEN
+            self.probing = True
+
+    def finished(self, success, latency, failureThreshold):
+        self.outstanding -= 1
+        if success:
+            self.latency = latency if self.latency is None else self.latency + EWMA_WEIGHT * (latency - self.latency)
+            self.failures = 0
+            self.state = self.CLOSED
+            self.probing = False
+        else:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= failureThreshold:
+                self.state = self.OPEN
+                self.openedAt = time.time()
+                self.probing = False
+
+
+class _Balancer(object):
+    """Endpoints of ExchangableService class. Proxies are reloaded on config change"""
+
+    def __init__(self, serviceClass):
+        self.serviceClass = serviceClass
+        self.endpoints = []
+        self._next = 0
+        self.update()
+        config.connect("changed", self.configChanged)
+
+    def configChanged(self, sender):
+        self.update()
+
+    def update(self):
+        known = dict((id(e.proxy), e) for e in self.endpoints) # getProxy returns the same proxy for the same url
+        self.endpoints = [known.get(id(p)) or _Endpoint(p) for p in self.serviceClass()._getProxies()]
+
+    def pick(self, exclude):
+        cls = self.serviceClass
+        now = time.time()
+        candidates = [e for e in self.endpoints if e not in exclude and e.available(now, cls.openTimeout)]
+        if not candidates:
+            raise NoRPCProxiesLeft("all proxies of %s are down" % cls.__name__)
+        self._next += 1
+        start = self._next % len(candidates) # rotation also breaks ties of other modes
+        candidates = candidates[start:] + candidates[:start]
+        return min(candidates, key=lambda e: e.load(cls.balancing))
+
+
 class ExchangableService(Service):
+    """
+    Service balancing calls between proxies returned by _getProxies.
+
+    Endpoint failing failureThreshold calls in a row is skipped for openTimeout seconds, then one probe
+    call decides if it's back. Calls failed to connect or timed out (see callTimeout) are retried on other
+    endpoints up to `retries` times (each endpoint once by default). XML-RPC faults are not retried.
+    """
+    balancing = BALANCE_ROUND_ROBIN
+    failureThreshold = 3
+    openTimeout = 30
+    callTimeout = None # seconds
+    retries = None
+
     def _getProxies(self):
         raise NotImplementedError("_getProxies must be implemented in an inherited class")
-    
-    def _getProxy(self):
+
+    def _getBalancer(self):
         cls = self.__class__
-        def updateProxies(sender):
-            cls._proxies = self._getProxies()
-            cls._currentProxyIndex = 0
-            cls._needNextProxy = False
-            
-        if not hasattr(cls, "_proxies"):
-            updateProxies()
-            config.connect("changed", updateProxies)
-            
-        if cls._needNextProxy:
-            nextIndex = (cls._currentProxyIndex + 1) % len(cls._proxies)
-            if nextIndex == cls.firstProxy:
-                raise NoRPCProxiesLeft("all proxies of %s are down" % self.__class__.__name__)
-            cls._currentProxyIndex = nextIndex
-        else: # remember first called proxy before failures
-            cls.firstProxy = cls._currentProxyIndex
-            
-        return cls._proxies[cls._currentProxyIndex]
-    
+        if "_balancer" not in cls.__dict__:
+            cls._balancer = _Balancer(cls)
+        return cls._balancer
+
     def __call__(self, *params):
-        
-        def checkConnection(failure):
-            failure.trap(ConnectionRefusedError)
-            print ("trying next proxy if available")
-            self.__class__._needNextProxy = True
-            return Service.__call__(self, *params).addErrback(checkConnection)
-        
-        self.__class__._needNextProxy = False
-        d = Service.__call__(self, *params)
-        d.addErrback(checkConnection)
-        return d
+        if not self._methodPath:
+            return defer.fail(InternalError("method name is not given"))
+        cls = self.__class__
+        balancer = self._getBalancer()
+        tried = [] # state of this call only
+
+        def attempt():
+            endpoint = balancer.pick(tried)
+            tried.append(endpoint)
+            endpoint.started()
+            d = self._callRemote(lambda: endpoint.proxy, params, cls.callTimeout)
+            d.addBoth(finished, endpoint, time.time())
+            return d
+
+        def finished(result, endpoint, startedAt):
+            failed = isinstance(result, failure.Failure) and not result.check(Fault)
+            endpoint.finished(not failed, time.time() - startedAt, cls.failureThreshold)
+            retries = len(balancer.endpoints) - 1 if cls.retries is None else cls.retries
+            if failed and result.check(ConnectError, TimeoutError) and len(tried) <= retries:
+                if debug.enabled:
+                    debug.trace("trying next proxy if available")
+                return defer.maybeDeferred(attempt)
+            return result
+
+        return defer.maybeDeferred(attempt)
+
+